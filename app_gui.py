@@ -33,11 +33,16 @@ logger = logging.getLogger(__name__)
 # Server configuration
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 8085
+# MCP transport, shared with the in-process client: "sse" or "streamable-http"
+SERVER_TRANSPORT = os.environ.get("MCP_TRANSPORT", "sse")
+# Streamable HTTP only: run the server without per-client session state
+SERVER_STATELESS = os.environ.get("MCP_STATELESS", "").lower() in ("1", "true", "yes")
 SERVER_CMD = [
     sys.executable, "-m", "src.server.mcp_server", 
     "--host", SERVER_HOST, 
-    "--port", str(SERVER_PORT)
-]
+    "--port", str(SERVER_PORT),
+    "--transport", SERVER_TRANSPORT,
+] + (["--stateless"] if SERVER_STATELESS else [])
 
 class MCPClientGUI:
     def __init__(self):
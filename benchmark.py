@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks for MCP Client X
+
+Usage: python benchmark.py [benchmark ...]
+Runs every benchmark when none is given.
+"""
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def timed(func, repeat=5):
+    """Run func repeat times and return the best wall time in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_listing(entries=100_000):
+    """Compare the old listdir + is_file/is_dir listing with the single scandir pass"""
+    from pathlib import Path
+    from src.server.mcp_server import scan_directory
+
+    print(f"Creating {entries} directory entries...")
+    root = tempfile.mkdtemp(prefix="mcp_bench_listing_")
+    try:
+        for i in range(entries):
+            if i % 10 == 0:
+                os.mkdir(os.path.join(root, f"dir_{i:06d}"))
+            else:
+                open(os.path.join(root, f"file_{i:06d}.txt"), "w").close()
+
+        def listdir_listing():
+            target_path = Path(root)
+            items = os.listdir(target_path)
+            files = [item for item in items if (target_path / item).is_file()]
+            directories = [item for item in items if (target_path / item).is_dir()]
+            return files, directories
+
+        results = [
+            ("listdir + is_file/is_dir", timed(listdir_listing)),
+            ("scandir", timed(lambda: scan_directory(root))),
+            ("scandir + metadata", timed(lambda: scan_directory(root, include_metadata=True))),
+        ]
+        baseline = results[0][1]
+        for name, seconds in results:
+            print(f"  {name:<28} {seconds * 1000:9.1f} ms  ({baseline / seconds:4.1f}x)")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_payload(root="/usr", query="python", model="qwen3:8b"):
+    """Compare search_items payload sizes (and Ollama prefill, when reachable) for flat and tree results"""
+    import json
+    from src.server.mcp_server import find_items
+    from src.client.mcp_client import tool_output_to_content
+
+    flat = find_items(root, query)
+    tree = find_items(root, query, result_format="tree")
+    if "error" in flat:
+        print(f"Search failed: {flat['error']}")
+        return
+    print(f"{len(flat['found_files'])} files, {len(flat['found_directories'])} directories under {root} match '{query}'")
+
+    # What went into conversation_history before: the indented tool text, JSON-encoded again
+    payloads = [
+        ("flat, double-encoded (old)", json.dumps(json.dumps(flat, indent=2))),
+        ("flat, minified", tool_output_to_content(json.dumps(flat, indent=2))),
+        ("tree, minified", tool_output_to_content(json.dumps(tree, indent=2))),
+    ]
+    baseline = len(payloads[0][1].encode())
+    for name, payload in payloads:
+        size = len(payload.encode())
+        print(f"  {name:<28} {size:>10} bytes  ({size / baseline:6.1%})")
+
+    try:
+        import ollama
+        client = ollama.Client()
+        client.show(model)
+    except Exception as e:
+        print(f"Skipping prefill measurement, Ollama/{model} not available: {e}")
+        return
+
+    print(f"Prefill with {model}:")
+    for name, payload in payloads:
+        response = client.chat(
+            model=model,
+            messages=[{"role": "user", "content": payload}],
+            options={"num_predict": 1, "num_ctx": 131072},
+        )
+        tokens = response.get("prompt_eval_count") or 0
+        millis = (response.get("prompt_eval_duration") or 0) / 1e6
+        print(f"  {name:<28} {tokens:>8} tokens  {millis:9.1f} ms")
+
+
+def bench_transport(connections=20, calls=200, port=8095):
+    """Compare connection setup and per-call latency of the SSE and streamable HTTP transports"""
+    import asyncio
+    import socket
+    import subprocess
+    from mcp import ClientSession
+    from src.client.mcp_client import connect_transport
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    url = f"http://127.0.0.1:{port}/mcp"
+
+    def wait_for_port(timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with socket.socket() as sock:
+                if sock.connect_ex(("127.0.0.1", port)) == 0:
+                    return True
+            time.sleep(0.1)
+        return False
+
+    async def measure(transport):
+        setup = []
+        for _ in range(connections):
+            start = time.perf_counter()
+            async with connect_transport(url, transport) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    setup.append(time.perf_counter() - start)
+        latencies = []
+        async with connect_transport(url, transport) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                for _ in range(calls):
+                    start = time.perf_counter()
+                    await session.call_tool("list_items", arguments={"path": "."})
+                    latencies.append(time.perf_counter() - start)
+        return setup, latencies
+
+    def percentile(values, fraction):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+    modes = [
+        ("sse", "sse", []),
+        ("streamable-http (stateful)", "streamable-http", []),
+        ("streamable-http (stateless)", "streamable-http", ["--stateless"]),
+    ]
+    print(f"{connections} connections (connect + initialize), {calls} list_items calls per mode")
+    for name, transport, extra_args in modes:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "src.server.mcp_server", "--port", str(port),
+             "--transport", transport, "--log-level", "WARNING"] + extra_args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not wait_for_port():
+                print(f"  {name}: server did not start")
+                continue
+            setup, latencies = asyncio.run(measure(transport))
+            print(
+                f"  {name:<28} setup p50 {percentile(setup, 0.5):6.1f} ms  p95 {percentile(setup, 0.95):6.1f} ms"
+                f"   call p50 {percentile(latencies, 0.5):6.2f} ms  p95 {percentile(latencies, 0.95):6.2f} ms"
+            )
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+
+def bench_servers(servers=4, base_port=8100, repeat=5, rtt_ms=20):
+    """
+    Compare connecting to several MCP servers one after another with the parallel
+    ServerPool. The servers are reached through a local proxy adding rtt_ms of round
+    trip time, as servers on other machines would.
+    """
+    import asyncio
+    import logging
+    import socket
+    import subprocess
+    import threading
+    from mcp import ClientSession
+    from src.client.mcp_client import MCP_TRANSPORT, ServerPool, connect_transport
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ports = [base_port + i for i in range(servers)]
+    proxy_ports = [port + 100 for port in ports]
+    urls = {f"node{i + 1}": f"http://127.0.0.1:{port}/mcp" for i, port in enumerate(proxy_ports)}
+
+    async def pipe(reader, writer):
+        # Data keeps its order; each chunk arrives half a round trip after it was sent
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while (item := await queue.get()) is not None:
+                due, data = item
+                await asyncio.sleep(max(0.0, due - loop.time()))
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        task = asyncio.create_task(deliver())
+        while data := await reader.read(65536):
+            queue.put_nowait((loop.time() + rtt_ms / 2000, data))
+        queue.put_nowait(None)
+        await task
+
+    async def run_proxies(ready):
+        async def forward(target_port, client_reader, client_writer):
+            server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+            await asyncio.gather(pipe(client_reader, server_writer), pipe(server_reader, client_writer),
+                                 return_exceptions=True)
+
+        for port, proxy_port in zip(ports, proxy_ports):
+            await asyncio.start_server(lambda r, w, port=port: forward(port, r, w), "127.0.0.1", proxy_port)
+        ready.set()
+        await asyncio.Event().wait()
+
+    proxies_ready = threading.Event()
+    threading.Thread(target=lambda: asyncio.run(run_proxies(proxies_ready)), daemon=True).start()
+
+    def port_open(port):
+        with socket.socket() as sock:
+            return sock.connect_ex(("127.0.0.1", port)) == 0
+
+    # Both return the time until every server is ready, leaving out the shutdown
+    async def serial():
+        start = time.perf_counter()
+        async with contextlib.AsyncExitStack() as stack:
+            for url in urls.values():
+                read, write = await stack.enter_async_context(connect_transport(url, MCP_TRANSPORT))
+                session = await stack.enter_async_context(ClientSession(read, write))
+                await session.initialize()
+                await session.list_tools()
+            return time.perf_counter() - start
+
+    async def parallel():
+        start = time.perf_counter()
+        async with ServerPool(urls):
+            return time.perf_counter() - start
+
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "src.server.mcp_server", "--port", str(port), "--transport", MCP_TRANSPORT,
+             "--log-level", "WARNING"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for port in ports
+    ]
+    try:
+        deadline = time.monotonic() + 15
+        while not all(port_open(port) for port in ports) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        proxies_ready.wait(timeout=5)
+        print(f"{servers} servers at {rtt_ms} ms round trip time, connect + initialize + list_tools")
+        for name, func in (("one after another", serial), ("ServerPool (parallel)", parallel)):
+            seconds = min(asyncio.run(func()) for _ in range(repeat))
+            print(f"  {name:<28} {seconds * 1000:7.1f} ms")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+
+def bench_compression(root="/usr"):
+    """Bandwidth saved versus CPU spent by the server's response compression"""
+    import json
+    from src.server.mcp_server import _StreamCompressor, find_items, list_items, zstandard
+
+    payloads = [
+        ("search_items flat", json.dumps(find_items(root, "python"), indent=2).encode()),
+        ("search_items tree", json.dumps(find_items(root, "python", result_format="tree"), indent=2).encode()),
+        ("list_items + metadata", json.dumps(list_items(os.path.join(root, "lib"), include_metadata=True), indent=2).encode()),
+        ("weather (small)", b'{"latitude":52.52,"longitude":13.42,"current":{"time":"2025-01-01T12:00","temperature_2m":3.1}}'),
+    ]
+    codecs = [("gzip", 1), ("gzip", 6), ("gzip", 9)]
+    if zstandard is not None:
+        codecs += [("zstd", 1), ("zstd", 3), ("zstd", 10)]
+    else:
+        print("zstandard not installed, measuring gzip only")
+
+    for name, payload in payloads:
+        print(f"  {name} ({len(payload)} bytes)")
+        for encoding, level in codecs:
+            seconds = timed(lambda: _StreamCompressor(encoding, level).compress(payload, final=True), repeat=20)
+            size = len(_StreamCompressor(encoding, level).compress(payload, final=True))
+            print(f"    {encoding:<5} level {level:<2} {size:>9} bytes ({size / len(payload):6.1%})  {seconds * 1000:7.2f} ms")
+
+
+BENCHMARKS = {
+    "listing": bench_listing,
+    "payload": bench_payload,
+    "transport": bench_transport,
+    "compression": bench_compression,
+    "servers": bench_servers,
+}
+
+
+def main():
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}")
+            return 1
+    for name in selected:
+        print(f"\n--- {name} ---")
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
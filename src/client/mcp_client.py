@@ -1,9 +1,26 @@
 from mcp import ClientSession, types
 from mcp.client.sse import sse_client
+from mcp.client.streamable_http import streamablehttp_client
+from mcp.shared.exceptions import McpError
+import anyio
+import contextlib
+import itertools
 import logging
 import json
 import os
+import math
+import queue
+import re
+import socket
+import struct
+import threading
+import time
 import asyncio
+import httpx
+from collections import OrderedDict
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import urlparse
 import ollama
 
 
@@ -14,361 +31,1424 @@ logging.basicConfig(level=logging.INFO)
 # Define HTTP server connection parameters
 HTTP_HOST = "127.0.0.1"
 HTTP_PORT = 8085
-MCP_SSE_ENDPOINT = f"http://{HTTP_HOST}:{HTTP_PORT}/mcp" # Full URL for the SSE endpoint
+MCP_ENDPOINT = f"http://{HTTP_HOST}:{HTTP_PORT}/mcp" # Full URL of the MCP endpoint
+MCP_SSE_ENDPOINT = MCP_ENDPOINT
+# "sse" or "streamable-http"; must match the server's --transport
+MCP_TRANSPORT = os.environ.get("MCP_TRANSPORT", "sse")
+# Joins server name and tool name when tools of several servers are offered together
+TOOL_NAMESPACE_SEPARATOR = "__"
+# Seconds to wait for a server to connect, initialize and list its tools before skipping it
+MCP_CONNECT_TIMEOUT = 10.0
+
+
+def parse_servers(spec):
+    """
+    Parses an MCP_SERVERS value: comma-separated endpoint URLs, each optionally
+    written as name=url. Unnamed servers are named after their host.
+    Returns a dict of server name -> URL.
+    """
+    servers = {}
+    for position, item in enumerate(part.strip() for part in spec.split(",")):
+        if not item:
+            continue
+        name, separator, url = item.partition("=")
+        if not separator or "://" in name:
+            name, url = urlparse(item).hostname or f"server{position + 1}", item
+        name = re.sub(r"[^A-Za-z0-9-]+", "_", name.strip()).strip("_") or f"server{position + 1}"
+        if name in servers:
+            # e.g. several servers on one host: tell them apart by port
+            port = urlparse(url.strip()).port
+            name = f"{name}_{port}" if port and f"{name}_{port}" not in servers else f"{name}_{position + 1}"
+        servers[name] = url.strip()
+    return servers
+
+
+# Servers whose tools are offered to the model, e.g. "node1=http://10.0.0.1:8085/mcp,node2=http://10.0.0.2:8085/mcp"
+MCP_SERVERS = parse_servers(os.environ.get("MCP_SERVERS", "")) or {"local": MCP_ENDPOINT}
+
+
+# Tool calls carry a client-side call id in _meta; the JSON-RPC request id the session
+# assigns to it is noted when the request is written, for cancellation notifications
+CALL_ID_META_KEY = "call_id"
+_call_ids = itertools.count(1)
+_sent_request_ids = {}  # call id -> JSON-RPC request id
+
+
+class _RequestIdTap:
+    """Transport write stream wrapper recording the request id of each tool call sent with a call id"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def send(self, message):
+        request = message.message.root
+        if isinstance(request, types.JSONRPCRequest) and request.method == "tools/call":
+            call_id = ((request.params or {}).get("_meta") or {}).get(CALL_ID_META_KEY)
+            if call_id is not None:
+                _sent_request_ids[call_id] = request.id
+        await self._stream.send(message)
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._stream.__aexit__(exc_type, exc, tb)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+_ssl_context = None
+
+
+def create_http_client(headers=None, timeout=None, auth=None):
+    """
+    httpx client factory for the MCP transports. Same defaults as mcp's own factory,
+    but every connection shares one SSL context: building one takes ~40 ms of CPU,
+    which would otherwise be paid again for each server connected.
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout or httpx.Timeout(30.0, read=300.0),
+        auth=auth,
+        verify=_ssl_context,
+    )
+
+
+@contextlib.asynccontextmanager
+async def connect_transport(url=MCP_ENDPOINT, transport=MCP_TRANSPORT):
+    """Opens the configured MCP transport and yields its (read, write) streams"""
+    if transport == "streamable-http":
+        # Works with both stateful and stateless servers, the session id is handled by the transport
+        async with streamablehttp_client(url, httpx_client_factory=create_http_client) as (read, write, _get_session_id):
+            yield read, _RequestIdTap(write)
+    elif transport == "sse":
+        async with sse_client(url, httpx_client_factory=create_http_client) as (read, write):
+            yield read, _RequestIdTap(write)
+    else:
+        raise ValueError(f"Unknown MCP transport: {transport}. Expected 'sse' or 'streamable-http'")
+
+def base_tool_name(tool_name):
+    """The tool's name on its server, without the server prefix"""
+    return tool_name.rpartition(TOOL_NAMESPACE_SEPARATOR)[2]
+
+
+class ServerPool:
+    """
+    Keeps one MCP session open per server for the whole run. The servers are connected,
+    initialized and asked for their tools concurrently, so startup takes as long as the
+    slowest server instead of the sum of all. With more than one server configured, tool
+    names get the server name as prefix (server__tool) and each call is routed to the
+    server owning the tool. Servers that cannot be reached are skipped with a warning.
+    """
+
+    def __init__(self, servers=None, transport=MCP_TRANSPORT, sampling_callback=None,
+                 connect_timeout=MCP_CONNECT_TIMEOUT):
+        self.servers = dict(servers or MCP_SERVERS)
+        self.transport = transport
+        self.sampling_callback = sampling_callback
+        self.connect_timeout = connect_timeout
+        self.namespaced = len(self.servers) > 1
+        self.sessions = {}  # server name -> ClientSession
+        self.tools = []
+        self._routes = {}  # offered tool name -> (server name, tool name on the server)
+        self._stop = None
+        self._tasks = []
+
+    async def __aenter__(self):
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        ready = {name: loop.create_future() for name in self.servers}
+        self._tasks = [asyncio.create_task(self._serve(name, url, ready[name])) for name, url in self.servers.items()]
+        results = await asyncio.gather(*ready.values(), return_exceptions=True)
+        for name, result in zip(ready, results):
+            if isinstance(result, BaseException):
+                logging.warning(f"Skipping MCP server {name} at {self.servers[name]}: {result!r}")
+                continue
+            session, tools = result
+            self.sessions[name] = session
+            for tool in tools:
+                offered_name = f"{name}{TOOL_NAMESPACE_SEPARATOR}{tool.name}" if self.namespaced else tool.name
+                self._routes[offered_name] = (name, tool.name)
+                self.tools.append(tool.model_copy(update={"name": offered_name}) if self.namespaced else tool)
+        if not self.sessions:
+            await self.__aexit__(None, None, None)
+            raise ConnectionError(f"Could not connect to any MCP server: {', '.join(self.servers.values())}")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._stop.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=5)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _serve(self, name, url, ready):
+        # The transport's task groups must be exited by the task that entered them,
+        # so each server gets a task holding its session open until the pool closes
+        try:
+            # The timeout covers connecting up to the tool list; a server that misses it
+            # is given up on here, so no late session is left open
+            with anyio.fail_after(self.connect_timeout) as connect_deadline:
+                async with connect_transport(url, self.transport) as (read, write):
+                    async with ClientSession(read, write, sampling_callback=self.sampling_callback) as session:
+                        await session.initialize()
+                        tools = await session.list_tools()
+                        connect_deadline.deadline = math.inf
+                        ready.set_result((session, tools.tools))
+                        await self._stop.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            elif not self._stop.is_set():
+                logging.warning(f"Connection to MCP server {name} closed: {e!r}")
+                self.sessions.pop(name, None)
+
+    async def list_tools(self):
+        """Returns the tools of every connected server, under their offered names"""
+        return types.ListToolsResult(tools=self.tools)
+
+    def route(self, tool_name):
+        """Returns the session owning tool_name and the tool's name on that server"""
+        route = self._routes.get(tool_name)
+        if route is None and not self.namespaced:
+            # A single server decides itself whether it knows the tool
+            route = (next(iter(self.servers)), tool_name)
+        if route is None or route[0] not in self.sessions:
+            raise ValueError(f"Unknown tool or server not connected: {tool_name}")
+        return self.sessions[route[0]], route[1]
+
+    async def call_tool(self, tool_name, arguments=None, **kwargs):
+        session, server_tool_name = self.route(tool_name)
+        return await session.call_tool(server_tool_name, arguments=arguments, **kwargs)
+
 
 # Initialize Ollama client
 ollama_client = ollama.AsyncClient()
 
+# Client-side cache for results of read-only tools
+TOOL_CACHE_MAX_ENTRIES = 128
+TOOL_CACHE_TTL_SECONDS = 60.0
+# Tools whose results can be reused; tools annotated with readOnlyHint are added on top
+READ_ONLY_TOOLS = {"list_items", "search_items", "read_text_file"}
+# Arguments holding the path a tool reads from or writes to
+TOOL_PATH_ARGUMENTS = ("path", "file_path", "directory_path")
+WRITE_TOOLS = {"create_text_file", "create_directory", "batch_operations"}
+
+_ERROR_RESULT_RE = re.compile(r'\s*\{\s*"error"\s*:')
+_TRUNCATED_RESULT_RE = re.compile(r'"truncated"\s*:\s*true')
+
+# Deadline in seconds sent with calls of these tools; when it passes the server stops
+# and returns what it found so far, marked as truncated
+TOOL_DEADLINES = {"search_items": 30.0}
+# How long to wait for the (partial) result after the deadline before giving up on the call
+TOOL_DEADLINE_GRACE_SECONDS = 5.0
+
+
+def _normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _paths_overlap(a, b):
+    """True when one path is the other or one of its ancestors"""
+    if a == b:
+        return True
+    return b.startswith(a.rstrip(os.sep) + os.sep) or a.startswith(b.rstrip(os.sep) + os.sep)
+
+
+async def call_tool_with_deadline(session, tool_name, arguments, timeout=None):
+    """
+    Calls a tool, sending timeout (default: TOOL_DEADLINES) along as the call's deadline.
+    If the call is abandoned, because the task is cancelled or no answer arrived in
+    time, the server is sent a cancellation notification so it stops working on it.
+    """
+    if isinstance(session, ServerPool):
+        session, tool_name = session.route(tool_name)
+    timeout = TOOL_DEADLINES.get(base_tool_name(tool_name)) if timeout is None else timeout
+    call_id = next(_call_ids)
+    meta = {CALL_ID_META_KEY: call_id}
+    if timeout is not None:
+        meta["timeout"] = timeout
+    try:
+        return await session.call_tool(
+            tool_name,
+            arguments=arguments,
+            read_timeout_seconds=timedelta(seconds=timeout + TOOL_DEADLINE_GRACE_SECONDS) if timeout is not None else None,
+            meta=meta,
+        )
+    except (asyncio.CancelledError, McpError) as e:
+        if isinstance(e, McpError) and e.error.code != httpx.codes.REQUEST_TIMEOUT:
+            raise
+        request_id = _sent_request_ids.get(call_id)
+        if request_id is None:
+            # Not sent yet (nothing to cancel) or sent over a stream connect_transport did not open
+            raise
+        reason = "Client cancelled the call" if isinstance(e, asyncio.CancelledError) else "Client timed out"
+        try:
+            await asyncio.shield(session.send_notification(types.ClientNotification(
+                types.CancelledNotification(params=types.CancelledNotificationParams(requestId=request_id, reason=reason))
+            )))
+        except Exception as notify_error:
+            logging.debug(f"Could not send cancellation for {tool_name}: {notify_error}")
+        raise
+    finally:
+        _sent_request_ids.pop(call_id, None)
+
+
+class ToolResultCache:
+    """
+    Memoizes results of read-only tool calls, keyed on the tool name plus the
+    canonical JSON of its arguments. Entries expire after ttl seconds, the least
+    recently used ones are evicted beyond max_entries, and calls to write tools
+    drop every entry whose path overlaps a path being written.
+    """
+
+    def __init__(self, max_entries=TOOL_CACHE_MAX_ENTRIES, ttl=TOOL_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.read_only_tools = set(READ_ONLY_TOOLS)
+        self._entries = OrderedDict()  # key -> (stored_at, path, result)
+        self.hits = 0
+        self.misses = 0
+
+    def register_tools(self, tools):
+        """Marks tools the server annotates as read-only as cacheable"""
+        for tool_def in tools:
+            annotations = getattr(tool_def, 'annotations', None)
+            if annotations is not None and getattr(annotations, 'readOnlyHint', False):
+                self.read_only_tools.add(tool_def.name)
+
+    async def call(self, session, tool_name, arguments):
+        """Calls the tool through session, serving read-only tools from the cache when possible"""
+        kind = base_tool_name(tool_name)
+        if kind in WRITE_TOOLS:
+            self.invalidate_paths(self._written_paths(kind, arguments))
+            return await call_tool_with_deadline(session, tool_name, arguments)
+        if (tool_name not in self.read_only_tools and kind not in self.read_only_tools) or self.max_entries <= 0:
+            return await call_tool_with_deadline(session, tool_name, arguments)
+
+        key = (tool_name, json.dumps(arguments, sort_keys=True, separators=(",", ":"), default=str))
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+
+        result = await call_tool_with_deadline(session, tool_name, arguments)
+        if not self._is_error(result) and not self._is_truncated(result):
+            self._entries[key] = (time.monotonic(), self._read_path(arguments), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def invalidate_paths(self, paths):
+        """Drops cached results for any path overlapping one of paths"""
+        paths = [_normalize_path(p) for p in paths]
+        for key, (_, cached_path, _) in list(self._entries.items()):
+            if cached_path is None or any(_paths_overlap(cached_path, p) for p in paths):
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    @staticmethod
+    def _read_path(arguments):
+        for name in TOOL_PATH_ARGUMENTS:
+            if isinstance(arguments.get(name), str):
+                return _normalize_path(arguments[name])
+        return None
+
+    @staticmethod
+    def _written_paths(tool_name, arguments):
+        if tool_name == "batch_operations":
+            operations = arguments.get("operations") or []
+            return [op["path"] for op in operations if isinstance(op, dict) and isinstance(op.get("path"), str)]
+        return [arguments[name] for name in TOOL_PATH_ARGUMENTS if isinstance(arguments.get(name), str)]
+
+    @staticmethod
+    def _is_error(result):
+        if getattr(result, 'isError', False) or getattr(result, 'error', None):
+            return True
+        content = getattr(result, 'content', None)
+        if content and getattr(content[0], 'type', None) == 'text':
+            return bool(_ERROR_RESULT_RE.match(content[0].text))
+        return False
+
+    @staticmethod
+    def _is_truncated(result):
+        # Partial results (deadline passed) are not reused, a later call may get further
+        content = getattr(result, 'content', None)
+        return bool(content and getattr(content[0], 'type', None) == 'text'
+                    and _TRUNCATED_RESULT_RE.search(content[0].text))
+
+
+tool_result_cache = ToolResultCache()
+
+# Ask search_items for its compact prefix-tree result format unless the model picked one.
+# Not for ranked searches: the tree holds no order, rank_by 'depth' / 'recency' would be lost
+COMPACT_SEARCH_RESULTS = True
+# Upper bound on search_items matches unless the model asks for another; more would not fit the context anyway
+SEARCH_MAX_RESULTS = 500
+
+
+def prepare_tool_arguments(tool_name, tool_args_from_llm):
+    """Maps the arguments the model produced to the ones the server expects"""
+    tool_args_for_server = dict(tool_args_from_llm)
+    tool_name = base_tool_name(tool_name)
+    if tool_name == "calculate_bmi":
+        if "weight" in tool_args_for_server and "weight_kg" not in tool_args_for_server:
+            tool_args_for_server["weight_kg"] = tool_args_for_server.pop("weight")
+        if "height" in tool_args_for_server and "height_m" not in tool_args_for_server:
+            tool_args_for_server["height_m"] = tool_args_for_server.pop("height")
+    if tool_name == "search_items" and COMPACT_SEARCH_RESULTS and tool_args_for_server.get("rank_by") is None:
+        tool_args_for_server.setdefault("result_format", "tree")
+    if tool_name == "search_items" and SEARCH_MAX_RESULTS:
+        tool_args_for_server.setdefault("max_results", SEARCH_MAX_RESULTS)
+    return tool_args_for_server
+
+
+def tool_output_to_content(output):
+    """
+    Serializes a tool result for the conversation history. Text results that hold
+    JSON are re-emitted without indentation instead of being JSON-encoded a second
+    time, which would escape every quote and newline.
+    """
+    if isinstance(output, str):
+        try:
+            output = json.loads(output)
+        except ValueError:
+            return output
+    return json.dumps(output, separators=(",", ":"), ensure_ascii=False)
+
+
+def decode_path_tree(tree, root):
+    """
+    Expands a prefix tree returned by search_items(result_format='tree') into
+    (path, score) pairs, best match first. The tree keeps no other order, so the
+    order of a search ranked by depth or recency cannot be recovered from it.
+    """
+    matches = []
+    stack = [(root, tree)]
+    while stack:
+        base, node = stack.pop()
+        for name, value in node.items():
+            if name == ".":
+                matches.append((base, value))
+            elif isinstance(value, dict):
+                stack.append((os.path.join(base, name), value))
+            else:
+                matches.append((os.path.join(base, name), value))
+    matches.sort(key=lambda match: -match[1])
+    return matches
+
+
+def decode_compact_result(result):
+    """Converts a search_items result in 'tree' format back into the flat format"""
+    if not isinstance(result, dict) or result.get("result_format") != "tree":
+        return result
+    root = result["searched_path"]
+    files = decode_path_tree(result.get("file_tree", {}), root)
+    directories = decode_path_tree(result.get("directory_tree", {}), root)
+    flat = {key: value for key, value in result.items() if key not in ("result_format", "file_tree", "directory_tree")}
+    flat.update({
+        "found_files": [path for path, _ in files],
+        "found_directories": [path for path, _ in directories],
+        "file_scores": [score for _, score in files],
+        "directory_scores": [score for _, score in directories],
+    })
+    return flat
+
+# --- Ollama model management ---
+
+MODEL_NAME = "qwen3:8b"
+# How long Ollama keeps the model loaded after a request
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# Kept byte-identical across turns and sessions so Ollama can reuse the cached prompt prefix
+SYSTEM_PROMPT = "You are a helpful assistant. You have access to tools and should use them when appropriate to answer user queries or perform actions. /no_think"
+
+
+class PrefillStats:
+    """Collects Ollama load and prompt evaluation timings to report what warm-up and prefix reuse save"""
+
+    def __init__(self):
+        self.warm_up_load_ms = 0.0
+        self.prefix_tokens = 0
+        self.prefix_ms = 0.0
+        self.turns = 0
+        self.cached_turns = 0
+        self.evaluated_tokens = 0
+        self.evaluated_ms = 0.0
+
+    @staticmethod
+    def _millis(response, field):
+        return (response.get(field) or 0) / 1e6
+
+    def record_warm_up(self, response):
+        self.warm_up_load_ms = self._millis(response, 'load_duration')
+
+    def record_prefix(self, response):
+        self.prefix_tokens = response.get('prompt_eval_count') or 0
+        self.prefix_ms = self._millis(response, 'prompt_eval_duration')
+
+    def record_turn(self, response):
+        evaluated = response.get('prompt_eval_count') or 0
+        self.turns += 1
+        # Every prompt starts with the prefix, so evaluating fewer tokens than the prefix
+        # holds means Ollama reused its cache; otherwise the request paid the full prefill
+        if evaluated < self.prefix_tokens:
+            self.cached_turns += 1
+        self.evaluated_tokens += evaluated
+        self.evaluated_ms += self._millis(response, 'prompt_eval_duration')
+
+    def summary(self):
+        if self.prefix_tokens and self.prefix_ms:
+            ms_per_token = self.prefix_ms / self.prefix_tokens
+        elif self.evaluated_tokens:
+            ms_per_token = self.evaluated_ms / self.evaluated_tokens
+        else:
+            ms_per_token = 0.0
+        # Estimate: the prefix each cache hit skipped, at the measured prefill rate
+        saved_ms = self.cached_turns * self.prefix_tokens * ms_per_token
+        return (
+            f"model load moved to startup: {self.warm_up_load_ms:.0f} ms, "
+            f"cached prefix: {self.prefix_tokens} tokens reused by {self.cached_turns} of {self.turns} requests "
+            f"(~{saved_ms:.0f} ms of prefill saved at {ms_per_token:.2f} ms/token), "
+            f"evaluated: {self.evaluated_tokens} tokens in {self.evaluated_ms:.0f} ms"
+        )
+
+
+prefill_stats = PrefillStats()
+
+
+def build_ollama_tools(tools):
+    """
+    Converts MCP tool definitions to Ollama's format. Tools are sorted by name and
+    schemas are key-sorted so the serialized tools block is byte-identical every time.
+    """
+    ollama_tools_definition = []
+    for tool_def in sorted(tools, key=lambda tool_def: tool_def.name):
+        parameters_schema_for_ollama = getattr(tool_def, 'inputSchema', None) or getattr(tool_def, 'input_schema', None)
+        if not parameters_schema_for_ollama or not isinstance(parameters_schema_for_ollama, dict):
+            # Ollama requires a parameters object, even if it's for a tool with no parameters.
+            parameters_schema_for_ollama = {"type": "object", "properties": {}}
+        ollama_tools_definition.append({
+            "type": "function",
+            "function": {
+                "name": tool_def.name,
+                "description": tool_def.description,
+                "parameters": json.loads(json.dumps(parameters_schema_for_ollama, sort_keys=True)),
+            }
+        })
+    return ollama_tools_definition
+
+
+async def chat(messages, tools=None):
+    """Sends a chat request to Ollama, keeping the model loaded and recording prefill timings"""
+    start = time.perf_counter()
+    response = await ollama_client.chat(
+        model=MODEL_NAME,
+        messages=messages,
+        tools=tools or None,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+    )
+    prefill_stats.record_turn(response)
+    if session_recorder is not None:
+        session_recorder.record_model(response, time.perf_counter() - start)
+    return response
+
+
+async def warm_up_model():
+    """Loads the model into Ollama; runs concurrently with the MCP session setup"""
+    try:
+        response = await ollama_client.generate(model=MODEL_NAME, prompt="", keep_alive=OLLAMA_KEEP_ALIVE)
+        prefill_stats.record_warm_up(response)
+        logging.info(f"Model {MODEL_NAME} warmed up (load took {prefill_stats.warm_up_load_ms:.0f} ms)")
+    except Exception as e:
+        logging.warning(f"Model warm-up failed: {e}")
+
+
+async def prime_prompt_prefix(ollama_tools_definition, warm_up_task=None):
+    """Evaluates the system prompt and tool definitions once so the first turn finds them in Ollama's cache"""
+    try:
+        if warm_up_task is not None:
+            await warm_up_task
+        response = await ollama_client.chat(
+            model=MODEL_NAME,
+            messages=[{"role": "system", "content": SYSTEM_PROMPT}],
+            tools=ollama_tools_definition or None,
+            options={"num_predict": 1},
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+        prefill_stats.record_prefix(response)
+    except Exception as e:
+        logging.warning(f"Priming the prompt prefix failed: {e}")
+
+
+# --- Tool routing ---
+
+# With more tools than this, only the TOOL_ROUTER_TOP_K most relevant ones are sent per request.
+# Smaller toolsets are always sent whole, which keeps the prompt prefix cacheable.
+TOOL_ROUTER_MIN_TOOLS = 8
+TOOL_ROUTER_TOP_K = 4
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _tokenize(text):
+    # Splits snake_case names too and folds simple plurals ("items" -> "item")
+    return [token[:-1] if len(token) > 3 and token.endswith("s") else token
+            for token in _TOKEN_RE.findall((text or "").lower())]
+
+
+class ToolRouter:
+    """
+    Picks the tools worth sending with a request by scoring each tool's name,
+    description and parameter names against the user's message with BM25.
+    Tools the model called on the previous turn are always kept, so short
+    follow-ups ("yes, do that") still have them.
+    """
+
+    def __init__(self, top_k=TOOL_ROUTER_TOP_K, min_tools=TOOL_ROUTER_MIN_TOOLS, k1=1.5, b=0.75):
+        self.top_k = top_k
+        self.min_tools = min_tools
+        self.k1 = k1
+        self.b = b
+        self.all_tools = []
+        self.recently_used = set()
+        self._documents = []
+        self._idf = {}
+        self._avg_length = 0.0
+
+    def set_tools(self, ollama_tools_definition):
+        self.all_tools = list(ollama_tools_definition)
+        self._documents = []
+        document_frequency = {}
+        for tool in self.all_tools:
+            function = tool["function"]
+            properties = function.get("parameters", {}).get("properties", {})
+            tokens = _tokenize(" ".join([function["name"], function.get("description") or "", " ".join(properties)]))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            self._documents.append((counts, len(tokens)))
+            for token in counts:
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        count = len(self._documents)
+        self._idf = {token: math.log(1 + (count - df + 0.5) / (df + 0.5)) for token, df in document_frequency.items()}
+        self._avg_length = sum(length for _, length in self._documents) / count if count else 0.0
+
+    def score(self, message):
+        """Returns the BM25 score of every tool for message, in tool order"""
+        query = set(_tokenize(message))
+        scores = []
+        for counts, length in self._documents:
+            norm = self.k1 * (1 - self.b + self.b * length / (self._avg_length or 1))
+            score = 0.0
+            for token in query:
+                frequency = counts.get(token)
+                if frequency:
+                    score += self._idf[token] * frequency * (self.k1 + 1) / (frequency + norm)
+            scores.append(score)
+        return scores
+
+    def select(self, message):
+        """Returns the tools to send for message, in the same order as the full list"""
+        if len(self.all_tools) < self.min_tools:
+            return self.all_tools
+        scores = self.score(message)
+        if not any(scores):
+            # Nothing to go on, let the model see everything
+            return self.all_tools
+        ranked = sorted(range(len(scores)), key=lambda i: -scores[i])
+        chosen = {i for i in ranked[:self.top_k] if scores[i] > 0}
+        chosen.update(i for i, tool in enumerate(self.all_tools) if tool["function"]["name"] in self.recently_used)
+        return [tool for i, tool in enumerate(self.all_tools) if i in chosen]
+
+    @staticmethod
+    def requests_unknown_tool(assistant_message, tools):
+        """True when the model called a tool that was not offered in this request"""
+        offered = {tool["function"]["name"] for tool in tools}
+        return any(tool_call['function']['name'] not in offered for tool_call in assistant_message.get('tool_calls') or [])
+
+    def record_used(self, assistant_message):
+        self.recently_used = {tool_call['function']['name'] for tool_call in assistant_message.get('tool_calls') or []}
+
+
+tool_router = ToolRouter()
+
+
+async def chat_with_tool_routing(messages, user_message):
+    """
+    Chats with only the tools relevant to user_message. If the model asks for a tool
+    it was not given, the request is repeated with the full toolset.
+    Returns the response and the tools that were sent, for the follow-up request.
+    """
+    tools = tool_router.select(user_message)
+    response = await chat(messages, tools)
+    if tools is not tool_router.all_tools and tool_router.requests_unknown_tool(response['message'], tools):
+        logging.info("Model asked for a tool outside the routed subset, retrying with all tools")
+        tools = tool_router.all_tools
+        response = await chat(messages, tools)
+    tool_router.record_used(response['message'])
+    return response, tools
+
+
+# --- Persistent conversation store ---
+
+# Where session logs are kept; one <id>.log / <id>.idx / <id>.snap triple per session
+SESSION_DIR = Path(os.environ.get("MCP_SESSION_DIR", Path.home() / "mcp_client_logs" / "sessions"))
+# Messages kept in memory (and sent to the model) besides the system prompt; older ones stay on disk
+MAX_IN_MEMORY_MESSAGES = 200
+# A snapshot of the in-memory window is written every this many messages
+SNAPSHOT_INTERVAL = 50
+
+_RECORD_HEADER = struct.Struct(">I")
+_INDEX_ENTRY = struct.Struct(">Q")
+
+
+def _message_to_dict(message):
+    """Converts ollama Message objects (and plain dicts) to JSON-serializable dicts"""
+    if hasattr(message, 'model_dump'):
+        return message.model_dump(exclude_none=True)
+    return dict(message)
+
+
+class ConversationStore:
+    """
+    Append-only, length-prefixed log of one conversation.
+
+    Every message is written as a 4-byte length plus its JSON to <id>.log, and the
+    record's offset goes to <id>.idx (8 bytes per message), so any message can be
+    read with one seek. Writes happen on a background thread. Every
+    SNAPSHOT_INTERVAL messages the in-memory window is saved to <id>.snap, so
+    resuming reads that snapshot plus at most SNAPSHOT_INTERVAL records, whatever the
+    length of the session. Only the last MAX_IN_MEMORY_MESSAGES messages are kept in
+    `messages`; older ones can be loaded with read_messages().
+    """
+
+    def __init__(self, session_id=None, system_prompt=SYSTEM_PROMPT, directory=SESSION_DIR,
+                 max_in_memory=MAX_IN_MEMORY_MESSAGES, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.session_id = session_id or time.strftime("%Y%m%d-%H%M%S")
+        self.max_in_memory = max_in_memory
+        self.snapshot_interval = snapshot_interval
+        self.log_path = self.directory / f"{self.session_id}.log"
+        self.index_path = self.directory / f"{self.session_id}.idx"
+        self.snapshot_path = self.directory / f"{self.session_id}.snap"
+
+        # messages[0] is the system prompt, messages[1:] are log records window_start.. count-1
+        self.messages = [{"role": "system", "content": system_prompt}]
+        self.window_start = 0
+        self.count = 0
+        self._load()
+
+        self._log = open(self.log_path, 'ab')
+        self._index = open(self.index_path, 'ab')
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_records, name="conversation-store", daemon=True)
+        self._writer.start()
+
+    @classmethod
+    def latest_session_id(cls, directory=SESSION_DIR):
+        """Returns the id of the most recently written session, or None"""
+        logs = sorted(Path(directory).glob("*.log"), key=lambda path: path.stat().st_mtime)
+        return logs[-1].stem if logs else None
+
+    def append(self, message):
+        """Adds a message to the conversation and queues it for writing"""
+        message = _message_to_dict(message)
+        self.messages.append(message)
+        self.count += 1
+        self._queue.put(("record", message))
+        self._trim()
+        if self.count % self.snapshot_interval == 0:
+            self._queue.put(("snapshot", self.count, self.window_start, self.messages[1:]))
+
+    def read_messages(self, start, stop=None):
+        """Loads messages start..stop-1 (all of them by default) from disk, e.g. turns no longer in memory"""
+        self.flush()
+        stop = self.count if stop is None else min(stop, self.count)
+        if start >= stop:
+            return []
+        with open(self.index_path, 'rb') as index, open(self.log_path, 'rb') as log:
+            index.seek(start * _INDEX_ENTRY.size)
+            (offset,) = _INDEX_ENTRY.unpack(index.read(_INDEX_ENTRY.size))
+            log.seek(offset)
+            return [self._read_record(log) for _ in range(stop - start)]
+
+    def flush(self):
+        """Blocks until every queued write is on disk"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self._log.close()
+        self._index.close()
+
+    def _trim(self):
+        excess = len(self.messages) - 1 - self.max_in_memory
+        if excess <= 0:
+            return
+        drop = excess
+        # Do not start the window in the middle of a turn (e.g. with a tool result)
+        while drop < len(self.messages) - 1 and self.messages[1 + drop].get("role") != "user":
+            drop += 1
+        if drop >= len(self.messages) - 1:
+            drop = excess
+        del self.messages[1:1 + drop]
+        self.window_start += drop
+
+    @staticmethod
+    def _read_record(log):
+        header = log.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            raise EOFError("Truncated record header")
+        (length,) = _RECORD_HEADER.unpack(header)
+        data = log.read(length)
+        if len(data) < length:
+            raise EOFError("Truncated record")
+        return json.loads(data)
+
+    def _load(self):
+        """Restores the in-memory window from the latest snapshot plus the records after it"""
+        if not self.index_path.exists() or not self.log_path.exists():
+            return
+
+        # Drop a partially written index entry or record left behind by a crash
+        index_size = self.index_path.stat().st_size
+        count = index_size // _INDEX_ENTRY.size
+        with open(self.log_path, 'r+b') as log, open(self.index_path, 'r+b') as index:
+            valid_end = 0
+            while count:
+                index.seek((count - 1) * _INDEX_ENTRY.size)
+                (offset,) = _INDEX_ENTRY.unpack(index.read(_INDEX_ENTRY.size))
+                log.seek(offset)
+                try:
+                    self._read_record(log)
+                    valid_end = log.tell()
+                    break
+                except (EOFError, ValueError):
+                    count -= 1
+            log.truncate(valid_end)
+            index.truncate(count * _INDEX_ENTRY.size)
+        self.count = count
+
+        snapshot_count, window = 0, []
+        if self.snapshot_path.exists():
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if snapshot["count"] <= count:
+                snapshot_count, window = snapshot["count"], snapshot["window"]
+                self.window_start = snapshot["window_start"]
+        if not snapshot_count:
+            # No snapshot yet: the session is shorter than one snapshot interval
+            self.window_start = 0
+        self.messages.extend(window)
+        tail_count = count - snapshot_count
+        if tail_count:
+            with open(self.index_path, 'rb') as index, open(self.log_path, 'rb') as log:
+                index.seek(snapshot_count * _INDEX_ENTRY.size)
+                (offset,) = _INDEX_ENTRY.unpack(index.read(_INDEX_ENTRY.size))
+                log.seek(offset)
+                self.messages.extend(self._read_record(log) for _ in range(tail_count))
+        self._trim()
+
+    def _write_records(self):
+        offset = self._log.seek(0, os.SEEK_END)
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if item[0] == "record":
+                    data = json.dumps(item[1], ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+                    # Record first, then its index entry: the index never points past the log
+                    self._log.write(_RECORD_HEADER.pack(len(data)) + data)
+                    self._log.flush()
+                    self._index.write(_INDEX_ENTRY.pack(offset))
+                    self._index.flush()
+                    offset += _RECORD_HEADER.size + len(data)
+                else:
+                    _, count, window_start, window = item
+                    os.fsync(self._log.fileno())
+                    os.fsync(self._index.fileno())
+                    tmp_path = self.snapshot_path.with_suffix(".snap.tmp")
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump({"count": count, "window_start": window_start, "window": window}, f,
+                                  ensure_ascii=False, separators=(",", ":"))
+                    os.replace(tmp_path, self.snapshot_path)
+            except Exception as e:
+                logging.error(f"Writing conversation log failed: {e}")
+            finally:
+                self._queue.task_done()
+
+
+# --- Record and replay ---
+
+class SessionRecorder:
+    """
+    Writes user inputs, model responses and tool calls of a session to a JSON-lines
+    file, each with its time offset from the start of the recording and its latency,
+    so the session can be replayed later with replay_session().
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._start = time.monotonic()
+        self.tool_latencies = {}  # tool name -> [seconds]
+        self.model_latencies = []
+        self._write({"type": "header", "version": 1, "model": MODEL_NAME, "transport": MCP_TRANSPORT})
+
+    def _write(self, event):
+        event["t"] = round(time.monotonic() - self._start, 4)
+        self._file.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+
+    def record_user(self, content):
+        self._write({"type": "user", "content": content})
+
+    def record_model(self, response, latency):
+        self.model_latencies.append(latency)
+        self._write({"type": "model", "latency": round(latency, 4), "response": _message_to_dict(response)})
+
+    def record_tool(self, tool_name, arguments, result, latency):
+        self.tool_latencies.setdefault(tool_name, []).append(latency)
+        content = getattr(result, 'content', None) or []
+        text = content[0].text if content and getattr(content[0], 'type', None) == 'text' else None
+        self._write({
+            "type": "tool",
+            "name": tool_name,
+            "arguments": arguments,
+            "result": text,
+            "is_error": bool(getattr(result, 'isError', False)),
+            "latency": round(latency, 4),
+        })
+
+    def close(self):
+        self._file.close()
+
+
+session_recorder = None
+
+
+def start_recording(path):
+    """Starts recording every following model response, tool call and user input to path"""
+    global session_recorder
+    session_recorder = SessionRecorder(path)
+    return session_recorder
+
+
+async def call_tool(session, tool_name, arguments):
+    """Calls a tool through the result cache, recording the call when a recording is active"""
+    start = time.perf_counter()
+    result = await tool_result_cache.call(session, tool_name, arguments)
+    if session_recorder is not None:
+        session_recorder.record_tool(tool_name, arguments, result, time.perf_counter() - start)
+    return result
+
+
+async def read_user_input(prompt):
+    """Reads a line from the terminal in a thread, so background tasks keep running while the user types"""
+    return await asyncio.to_thread(input, prompt)
+
+
+def load_recording(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayOllamaClient:
+    """Stands in for ollama.AsyncClient, answering chat requests with the recorded responses in order"""
+
+    def __init__(self, events, speed):
+        self._responses = [event for event in events if event["type"] == "model"]
+        self._next = 0
+        self.speed = speed
+
+    async def generate(self, **kwargs):
+        return {}
+
+    async def chat(self, **kwargs):
+        if kwargs.get("options", {}).get("num_predict") == 1:
+            # Prompt prefix priming, which is not part of the recording
+            return {}
+        if self._next >= len(self._responses):
+            logging.warning("Replay ran out of recorded model responses")
+            return {"message": {"role": "assistant", "content": "(end of recording)"}}
+        event = self._responses[self._next]
+        self._next += 1
+        if self.speed:
+            # Keep the recorded model time, scaled, so the server sees the same pacing
+            await asyncio.sleep(event["latency"] / self.speed)
+        return event["response"]
+
+
+def write_weather_stub(events, path):
+    """Writes the recorded fetch_weather results in the format of the server's --weather-stub option"""
+    stub = {}
+    for event in events:
+        if event["type"] == "tool" and event["name"] == "fetch_weather" and event["result"] is not None:
+            arguments = event["arguments"]
+            stub[f"{float(arguments['latitude'])},{float(arguments['longitude'])}"] = event["result"]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(stub, f)
+    return stub
+
+
+def _free_port(host):
+    """Returns a TCP port on host that nothing listens on right now"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(host, port, timeout=15.0, process=None):
+    """
+    Waits until something accepts connections on host:port; False if it did not within
+    timeout, or if process (the server expected to listen there) exited meanwhile
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return process is None or process.poll() is None
+    return False
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else 0.0
+
+
+async def replay_session(path, speed=1.0, start_server=True, record_path=None):
+    """
+    Replays a recording made with --record: user inputs are fed to run() with their
+    original think time divided by speed (0 replays as fast as possible), the model is
+    replaced by the recorded responses, and tool calls go to a real MCP server whose
+    weather upstream is stubbed with the recorded results. Prints tool latencies of
+    the replay next to the recorded ones.
+    """
+    global ollama_client, read_user_input, session_recorder
+    import subprocess
+    import sys
+    import tempfile
+
+    events = load_recording(path)
+    work_dir = Path(tempfile.mkdtemp(prefix="mcp_replay_"))
+    server_process = None
+    servers = None
+    if start_server:
+        stub_path = work_dir / "weather_stub.json"
+        write_weather_stub(events, stub_path)
+        # A port of its own, so a server already running on HTTP_PORT (with the real
+        # weather upstream) cannot stand in for the stubbed one
+        port = _free_port(HTTP_HOST)
+        server_process = subprocess.Popen([
+            sys.executable, "-m", "src.server.mcp_server",
+            "--host", HTTP_HOST, "--port", str(port),
+            "--transport", MCP_TRANSPORT,
+            "--weather-stub", str(stub_path),
+            "--log-level", "WARNING",
+        ])
+        if not await wait_for_port(HTTP_HOST, port, process=server_process):
+            server_process.terminate()
+            server_process.wait(timeout=10)
+            raise RuntimeError(f"Replay server did not start on {HTTP_HOST}:{port}")
+        servers = {"local": f"http://{HTTP_HOST}:{port}/mcp"}
+
+    user_events = [event for event in events if event["type"] == "user"]
+
+    async def replay_input(prompt):
+        if not user_events:
+            return "exit"
+        event = user_events.pop(0)
+        if speed:
+            await asyncio.sleep(max(0.0, event["t"] - replay_input.last_t) / speed)
+        replay_input.last_t = event["t"]
+        print(f"{prompt}{event['content']}")
+        return event["content"]
+    replay_input.last_t = 0.0
+
+    original_client, original_input, original_recorder = ollama_client, read_user_input, session_recorder
+    ollama_client = ReplayOllamaClient(events, speed)
+    read_user_input = replay_input
+    recorder = start_recording(record_path or work_dir / "replay.jsonl")
+    started = time.perf_counter()
+    try:
+        # The replay server stands in for a single local server; otherwise use the configured ones
+        await run(session_dir=work_dir / "sessions", servers=servers)
+    finally:
+        elapsed = time.perf_counter() - started
+        ollama_client, read_user_input = original_client, original_input
+        session_recorder = original_recorder
+        recorder.close()
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait(timeout=10)
+
+    recorded = {}
+    for event in events:
+        if event["type"] == "tool":
+            recorded.setdefault(event["name"], []).append(event["latency"])
+    print(f"\n===== REPLAY SUMMARY ({elapsed:.2f} s wall time, speed {speed or 'max'}) =====")
+    for tool_name in sorted(set(recorded) | set(recorder.tool_latencies)):
+        before = recorded.get(tool_name, [])
+        after = recorder.tool_latencies.get(tool_name, [])
+        print(
+            f"{tool_name:<20} recorded {len(before):>4} calls p50 {_percentile(before, 0.5):8.2f} ms"
+            f" | replay {len(after):>4} calls p50 {_percentile(after, 0.5):8.2f} ms p95 {_percentile(after, 0.95):8.2f} ms"
+        )
+    print(f"Replay recording: {recorder.path}")
+
+
 # Store conversation history
 conversation_history = [
     {"role": "system", "content": "You are a helpful assistant."}
 ]
 
-async def run():
+
+async def handle_ollama_sampling(message: types.CreateMessageRequestParams) -> types.CreateMessageResult:
+    """Sampling callback that lets the server request completions from Ollama"""
+    try:
+        # Get the user's message content
+        user_content = ""
+        if message.messages and len(message.messages) > 0:
+            last_message = message.messages[-1]
+            if hasattr(last_message, "content"):
+                for content_item in last_message.content:
+                    if content_item.type == "text":
+                        user_content += content_item.text
+        
+        if not user_content:
+            user_content = "Hello, please assist me."
+        
+        # Update conversation history
+        conversation_history.append({"role": "user", "content": user_content})
+        
+        # Call Ollama API with the full conversation history
+        response = await chat(conversation_history)
+        
+        # Get the generated text from Ollama
+        ai_text = response['message']['content']
+        
+        # Update conversation history with assistant's response
+        conversation_history.append({"role": "assistant", "content": ai_text})
+        
+        return types.CreateMessageResult(
+            role="assistant",
+            content=types.TextContent(
+                type="text",
+                text=ai_text,
+            ),
+            model=MODEL_NAME,
+            stopReason="endTurn",
+        )
+    except Exception as e:
+        print(f"Error in Ollama sampling: {e}")
+        return types.CreateMessageResult(
+            role="assistant",
+            content=types.TextContent(
+                type="text",
+                text=f"I encountered an error: {str(e)}",
+            ),
+            model=MODEL_NAME,
+            stopReason="error",
+        )
+
+
+async def run(session_id=None, session_dir=SESSION_DIR, servers=None):
+    servers = servers or MCP_SERVERS
     print("\n===== MCP CLIENT WITH OLLAMA INTEGRATION (HTTP CONNECTION) =====")
-    print(f"This client connects to a local MCP server via HTTP/SSE at {MCP_SSE_ENDPOINT} and a local Ollama instance")
+    print(f"This client connects to {len(servers)} MCP server(s) via {MCP_TRANSPORT} and a local Ollama instance")
     
-    async with sse_client(MCP_SSE_ENDPOINT) as (read, write):
-        print(f"\nAttempting to connect to server via HTTP/SSE at {MCP_SSE_ENDPOINT}...")
+    conversation_store = ConversationStore(session_id, directory=session_dir)
+    if conversation_store.count:
+        print(f"Resumed session {conversation_store.session_id} ({conversation_store.count} messages)")
+    else:
+        print(f"Started session {conversation_store.session_id}")
+
+    # Load the model while the MCP connection is being set up
+    warm_up_task = asyncio.create_task(warm_up_model())
+
+    print(f"\nAttempting to connect to {', '.join(f'{name} at {url}' for name, url in servers.items())}...")
+    async with ServerPool(servers, sampling_callback=handle_ollama_sampling) as session:
+        print(f"Connected to {', '.join(session.sessions)}")
+
+        # List available tools (listed by each server while connecting)
+        tools = await session.list_tools()
         
-        # Create a sampling callback that uses Ollama
-        async def handle_ollama_sampling(message: types.CreateMessageRequestParams) -> types.CreateMessageResult:
-            try:
-                # Get the user's message content
-                user_content = ""
-                if message.messages and len(message.messages) > 0:
-                    last_message = message.messages[-1]
-                    if hasattr(last_message, "content"):
-                        for content_item in last_message.content:
-                            if content_item.type == "text":
-                                user_content += content_item.text
-                
-                if not user_content:
-                    user_content = "Hello, please assist me."
-                
-                # Update conversation history
-                conversation_history.append({"role": "user", "content": user_content})
-                
-                # Call Ollama API with the full conversation history
-                response = await ollama_client.chat(
-                    model="qwen3:8b",
-                    messages=conversation_history
-                )
+        # Prepare tool definitions for Ollama
+        ollama_tools_definition = []
+        if tools and tools.tools:
+            ollama_tools_definition = build_ollama_tools(tools.tools)
+            tool_router.set_tools(ollama_tools_definition)
+            tool_result_cache.register_tools(tools.tools)
+            tool_names_for_print = [tool_def.name for tool_def in tools.tools]
+            print(f"Found {len(tools.tools)} tools available for LLM: {', '.join(tool_names_for_print)}\n")
+        else:
+            print("No server-side tools found for LLM to use.\n")
+
+        prime_task = asyncio.create_task(prime_prompt_prefix(ollama_tools_definition, warm_up_task))
+
+        conversation_history = conversation_store.messages
+        
+        while True:
+            user_input = (await read_user_input("\nYou (type 'exit' to quit): ")).strip()
+            if user_input.lower() == 'exit':
+                break
                 
-                # Get the generated text from Ollama
-                ai_text = response['message']['content']
+            if session_recorder is not None:
+                session_recorder.record_user(user_input)
+            conversation_store.append({"role": "user", "content": user_input})
+            
+            try:
+                # Call Ollama with tool definitions
+                response, request_tools = await chat_with_tool_routing(conversation_history, user_input)
                 
-                # Update conversation history with assistant's response
-                conversation_history.append({"role": "assistant", "content": ai_text})
+                print(f"Ollama response: {response}")
+                assistant_message = response['message']
+                conversation_store.append(assistant_message) # Add assistant's response (potentially with tool_calls)
                 
-                return types.CreateMessageResult(
-                    role="assistant",
-                    content=types.TextContent(
-                        type="text",
-                        text=ai_text,
-                    ),
-                    model="qwen3:8b",
-                    stopReason="endTurn",
-                )
+                if assistant_message.get('tool_calls'):
+                    print("\nAssistant wants to use tools:")
+                    for tool_call in assistant_message['tool_calls']:
+                        tool_name = tool_call['function']['name']
+                        tool_args_from_llm = tool_call['function']['arguments']
+                        tool_call_id = tool_call.get('id', f"tool_{len(conversation_history)}")
+
+                        # Map arguments if necessary (e.g., for calculate_bmi)
+                        tool_args_for_server = prepare_tool_arguments(tool_name, tool_args_from_llm)
+
+                        print(f"  - Calling tool: {tool_name} with processed args: {json.dumps(tool_args_for_server)}")
+                        
+                        try:
+                            tool_call_response_object = await call_tool(session, tool_name, tool_args_for_server)
+                            
+                            # Check for server-side error in CallToolResult before accessing .result
+                            if hasattr(tool_call_response_object, 'error') and tool_call_response_object.error:
+                                error_content = tool_call_response_object.error
+                                print(f"  - Tool '{tool_name}' reported an error: {error_content}")
+                                # Store the error content for the LLM to process
+                                actual_tool_output_for_llm = {"error": error_content}
+                            elif hasattr(tool_call_response_object, 'result'):
+                                actual_tool_output_for_llm = tool_call_response_object.result
+                                print(f"  - Tool '{tool_name}' result: {json.dumps(actual_tool_output_for_llm)}")
+                            elif hasattr(tool_call_response_object, 'content') and \
+                                    isinstance(tool_call_response_object.content, list) and \
+                                    len(tool_call_response_object.content) > 0 and \
+                                    hasattr(tool_call_response_object.content[0], 'text') and \
+                                    getattr(tool_call_response_object.content[0], 'type', None) == 'text':
+                                # Extract text from the first text content block
+                                actual_tool_output_for_llm = tool_call_response_object.content[0].text
+                                print(f"  - Tool '{tool_name}' result (from content.text): {json.dumps(actual_tool_output_for_llm)}")
+                            else:
+                                # Fallback if structure is unexpected
+                                print(f"  - Tool '{tool_name}' returned an unexpected object: {tool_call_response_object}")
+                                actual_tool_output_for_llm = str(tool_call_response_object)
+
+                            conversation_store.append({
+                                "role": "tool",
+                                "tool_call_id": tool_call_id, 
+                                "name": tool_name,
+                                "content": tool_output_to_content(actual_tool_output_for_llm)
+                            })
+                        except Exception as e:
+                            print(f"  - Error calling tool {tool_name}: {e}")
+                            conversation_store.append({
+                                "role": "tool",
+                                "tool_call_id": tool_call_id,
+                                "name": tool_name,
+                                "content": json.dumps({"error": str(e)}) # Report error back to LLM
+                            })
+                    
+                    # Get final response from Ollama after tool execution
+                    final_response_obj = await chat(conversation_history, request_tools)
+                    final_assistant_text = final_response_obj['message']['content']
+                    print(f"\nAssistant: {final_assistant_text}")
+                    conversation_store.append(final_response_obj['message'])
+                    
+                else:
+                    # No tool calls, direct response
+                    assistant_response_text = assistant_message['content']
+                    print(f"\nAssistant: {assistant_response_text}")
+                    # Assistant message already added to history
+            
             except Exception as e:
-                print(f"Error in Ollama sampling: {e}")
-                return types.CreateMessageResult(
-                    role="assistant",
-                    content=types.TextContent(
-                        type="text",
-                        text=f"I encountered an error: {str(e)}",
-                    ),
-                    model="qwen3:8b",
-                    stopReason="error",
-                )
-        
+                print(f"\nError during chat processing: {e}")
+                # Add a generic error message to history to inform the LLM if needed for context
+                conversation_store.append({"role": "assistant", "content": f"An error occurred: {str(e)}"})
+
+        await prime_task
+        conversation_store.close()
+        print(f"\nPrefill stats: {prefill_stats.summary()}")
+
 
-        async with ClientSession(read, write, sampling_callback=handle_ollama_sampling) as session:
-            # Initialize the connection
-            print("Connection established, initializing session...")
-            await session.initialize()
             
-            # List available tools
-            print("Checking available tools...")
+
+async def run_gui_client(message_queue, response_queue, session_id=None, resume=True):
+    """
+    GUI-compatible version of the client that uses queues for communication.
+    Continues the most recent session unless a session_id is given or resume is False.
+    """
+    if session_id is None and resume:
+        session_id = ConversationStore.latest_session_id()
+    conversation_store = ConversationStore(session_id)
+    if os.environ.get("MCP_RECORD_FILE") and session_recorder is None:
+        start_recording(os.environ["MCP_RECORD_FILE"])
+    # Load the model while the MCP connection is being set up
+    warm_up_task = asyncio.create_task(warm_up_model())
+    try:
+        async with ServerPool(MCP_SERVERS, sampling_callback=handle_ollama_sampling) as session:
+            # List available tools (listed by each server while connecting)
             tools = await session.list_tools()
             
             # Prepare tool definitions for Ollama
-            server_tools_list_for_prompt = []
             ollama_tools_definition = []
             if tools and tools.tools:
-                for tool_def in tools.tools:
-                    # Ensure parameters is a valid JSON schema object, even if empty
-                    parameters_schema_for_ollama = {}
-                    if hasattr(tool_def, 'input_schema') and tool_def.input_schema and isinstance(tool_def.input_schema, dict):
-                        parameters_schema_for_ollama = tool_def.input_schema
-                    else:
-                        # Ollama requires a parameters object, even if it's for a tool with no parameters.
-                        # It should be a valid JSON schema.
-                        parameters_schema_for_ollama = {"type": "object", "properties": {}}
-
-                    server_tools_list_for_prompt.append({
-                        "name": tool_def.name,
-                        "description": tool_def.description,
-                        "parameters": parameters_schema_for_ollama # Corrected usage
-                    })
-                    ollama_tools_definition.append({
-                        "type": "function",
-                        "function": {
-                            "name": tool_def.name,
-                            "description": tool_def.description,
-                            "parameters": parameters_schema_for_ollama, # Corrected usage
-                        }
-                    })
-                
-                tool_names_for_print = [tool_def.name for tool_def in tools.tools]
-                print(f"Found {len(tools.tools)} tools available for LLM: {', '.join(tool_names_for_print)}\n")
-            else:
-                print("No server-side tools found for LLM to use.\n")
+                ollama_tools_definition = build_ollama_tools(tools.tools)
+                tool_router.set_tools(ollama_tools_definition)
+                tool_result_cache.register_tools(tools.tools)
+            
+            conversation_history = conversation_store.messages
 
+            prime_task = asyncio.create_task(prime_prompt_prefix(ollama_tools_definition, warm_up_task))
             
-            conversation_history = [
-                {"role": "system", "content": "You are a helpful assistant. You have access to tools and should use them when appropriate to answer user queries or perform actions. /no_think"}
-            ]
+            response_queue.put("Client initialized successfully! Ready to chat.")
+            if conversation_store.count:
+                response_queue.put(f"Resumed previous conversation ({conversation_store.count} messages).")
             
             while True:
-                user_input = input("\nYou (type 'exit' to quit): ").strip()
-                if user_input.lower() == 'exit':
-                    break
-                    
-                conversation_history.append({"role": "user", "content": user_input})
-                
                 try:
-                    # Call Ollama with tool definitions
-                    response = await ollama_client.chat(
-                        model="qwen3:8b",
-                        messages=conversation_history,
-                        tools=ollama_tools_definition if ollama_tools_definition else None
-                    )
-                    
-                    print(f"Ollama response: {response}")
-                    assistant_message = response['message']
-                    conversation_history.append(assistant_message) # Add assistant's response (potentially with tool_calls)
+                    # Check for new messages from GUI (non-blocking)
+                    user_input = None
+                    try:
+                        user_input = message_queue.get_nowait()
+                    except:
+                        await asyncio.sleep(0.1)
+                        continue
                     
-                    if assistant_message.get('tool_calls'):
-                        print("\nAssistant wants to use tools:")
-                        for tool_call in assistant_message['tool_calls']:
-                            tool_name = tool_call['function']['name']
-                            tool_args_from_llm = tool_call['function']['arguments']
-                            tool_call_id = tool_call.get('id', f"tool_{len(conversation_history)}")
-
-                            # Map arguments if necessary (e.g., for calculate_bmi)
-                            tool_args_for_server = tool_args_from_llm.copy()
-                            if tool_name == "calculate_bmi":
-                                if "weight" in tool_args_for_server and "weight_kg" not in tool_args_for_server:
-                                    tool_args_for_server["weight_kg"] = tool_args_for_server.pop("weight")
-                                if "height" in tool_args_for_server and "height_m" not in tool_args_for_server:
-                                    tool_args_for_server["height_m"] = tool_args_for_server.pop("height")
-
-                            print(f"  - Calling tool: {tool_name} with processed args: {json.dumps(tool_args_for_server)}")
-                            
-                            try:
-                                tool_call_response_object = await session.call_tool(tool_name, arguments=tool_args_for_server)
-                                
-                                # Check for server-side error in CallToolResult before accessing .result
-                                if hasattr(tool_call_response_object, 'error') and tool_call_response_object.error:
-                                    error_content = tool_call_response_object.error
-                                    print(f"  - Tool '{tool_name}' reported an error: {error_content}")
-                                    # Store the error content for the LLM to process
-                                    actual_tool_output_for_llm = {"error": error_content}
-                                elif hasattr(tool_call_response_object, 'result'):
-                                    actual_tool_output_for_llm = tool_call_response_object.result
-                                    print(f"  - Tool '{tool_name}' result: {json.dumps(actual_tool_output_for_llm)}")
-                                elif hasattr(tool_call_response_object, 'content') and \
-                                        isinstance(tool_call_response_object.content, list) and \
-                                        len(tool_call_response_object.content) > 0 and \
-                                        hasattr(tool_call_response_object.content[0], 'text') and \
-                                        getattr(tool_call_response_object.content[0], 'type', None) == 'text':
-                                    # Extract text from the first text content block
-                                    actual_tool_output_for_llm = tool_call_response_object.content[0].text
-                                    print(f"  - Tool '{tool_name}' result (from content.text): {json.dumps(actual_tool_output_for_llm)}")
-                                else:
-                                    # Fallback if structure is unexpected
-                                    print(f"  - Tool '{tool_name}' returned an unexpected object: {tool_call_response_object}")
-
-                                conversation_history.append({
-                                    "role": "tool",
-                                    "tool_call_id": tool_call_id, 
-                                    "name": tool_name,
-                                    "content": json.dumps(actual_tool_output_for_llm) 
-                                })
-                            except Exception as e:
-                                print(f"  - Error calling tool {tool_name}: {e}")
-                                conversation_history.append({
-                                    "role": "tool",
-                                    "tool_call_id": tool_call_id,
-                                    "name": tool_name,
-                                    "content": json.dumps({"error": str(e)}) # Report error back to LLM
-                                })
+                    if user_input and user_input.lower() == 'exit':
+                        break
                         
-                        # Get final response from Ollama after tool execution
-                        final_response_obj = await ollama_client.chat(
-                            model="qwen3:8b",
-                            messages=conversation_history,
-                            tools=ollama_tools_definition if ollama_tools_definition else None # Good to pass tools again
-                        )
-                        final_assistant_text = final_response_obj['message']['content']
-                        print(f"\nAssistant: {final_assistant_text}")
-                        conversation_history.append(final_response_obj['message'])
+                    if user_input:
+                        if session_recorder is not None:
+                            session_recorder.record_user(user_input)
+                        conversation_store.append({"role": "user", "content": user_input})
                         
-                    else:
-                        # No tool calls, direct response
-                        assistant_response_text = assistant_message['content']
-                        print(f"\nAssistant: {assistant_response_text}")
-                        # Assistant message already added to history
-                
-                except Exception as e:
-                    print(f"\nError during chat processing: {e}")
-                    # Add a generic error message to history to inform the LLM if needed for context
-                    conversation_history.append({"role": "assistant", "content": f"An error occurred: {str(e)}"})
-
-   
-                
-
-async def run_gui_client(message_queue, response_queue):
-    """GUI-compatible version of the client that uses queues for communication"""
-    try:
-        async with sse_client(MCP_SSE_ENDPOINT) as (read, write):
-            async with ClientSession(read, write, sampling_callback=handle_ollama_sampling) as session:
-                # Initialize the connection
-                await session.initialize()
-                
-                # List available tools
-                tools = await session.list_tools()
-                
-                # Prepare tool definitions for Ollama
-                server_tools_list_for_prompt = []
-                ollama_tools_definition = []
-                if tools and tools.tools:
-                    for tool_def in tools.tools:
-                        parameters_schema_for_ollama = {}
-                        if hasattr(tool_def, 'input_schema') and tool_def.input_schema and isinstance(tool_def.input_schema, dict):
-                            parameters_schema_for_ollama = tool_def.input_schema
-                        else:
-                            parameters_schema_for_ollama = {"type": "object", "properties": {}}
-
-                        server_tools_list_for_prompt.append({
-                            "name": tool_def.name,
-                            "description": tool_def.description,
-                            "parameters": parameters_schema_for_ollama
-                        })
-                        ollama_tools_definition.append({
-                            "type": "function",
-                            "function": {
-                                "name": tool_def.name,
-                                "description": tool_def.description,
-                                "parameters": parameters_schema_for_ollama,
-                            }
-                        })
-                
-                conversation_history = [
-                    {"role": "system", "content": "You are a helpful assistant. You have access to tools and should use them when appropriate to answer user queries or perform actions. /no_think"}
-                ]
-                
-                response_queue.put("Client initialized successfully! Ready to chat.")
-                
-                while True:
-                    try:
-                        # Check for new messages from GUI (non-blocking)
-                        user_input = None
                         try:
-                            user_input = message_queue.get_nowait()
-                        except:
-                            await asyncio.sleep(0.1)
-                            continue
-                        
-                        if user_input and user_input.lower() == 'exit':
-                            break
+                            # Call Ollama with tool definitions
+                            response, request_tools = await chat_with_tool_routing(conversation_history, user_input)
                             
-                        if user_input:
-                            conversation_history.append({"role": "user", "content": user_input})
+                            assistant_message = response['message']
+                            conversation_store.append(assistant_message)
                             
-                            try:
-                                # Call Ollama with tool definitions
-                                response = await ollama_client.chat(
-                                    model="qwen3:8b",
-                                    messages=conversation_history,
-                                    tools=ollama_tools_definition if ollama_tools_definition else None
-                                )
+                            if assistant_message.get('tool_calls'):
+                                response_queue.put("Using tools to help you...")
+                                for tool_call in assistant_message['tool_calls']:
+                                    tool_name = tool_call['function']['name']
+                                    tool_args_from_llm = tool_call['function']['arguments']
+                                    tool_call_id = tool_call.get('id', f"tool_{len(conversation_history)}")
+
+                                    # Map arguments if necessary
+                                    tool_args_for_server = prepare_tool_arguments(tool_name, tool_args_from_llm)
+
+                                    try:
+                                        tool_call_response_object = await call_tool(session, tool_name, tool_args_for_server)
+                                        
+                                        if hasattr(tool_call_response_object, 'error') and tool_call_response_object.error:
+                                            error_content = tool_call_response_object.error
+                                            actual_tool_output_for_llm = {"error": error_content}
+                                        elif hasattr(tool_call_response_object, 'result'):
+                                            actual_tool_output_for_llm = tool_call_response_object.result
+                                        elif hasattr(tool_call_response_object, 'content') and \
+                                                isinstance(tool_call_response_object.content, list) and \
+                                                len(tool_call_response_object.content) > 0 and \
+                                                hasattr(tool_call_response_object.content[0], 'text') and \
+                                                getattr(tool_call_response_object.content[0], 'type', None) == 'text':
+                                            actual_tool_output_for_llm = tool_call_response_object.content[0].text
+                                        else:
+                                            actual_tool_output_for_llm = str(tool_call_response_object)
+
+                                        conversation_store.append({
+                                            "role": "tool",
+                                            "tool_call_id": tool_call_id, 
+                                            "name": tool_name,
+                                            "content": tool_output_to_content(actual_tool_output_for_llm)
+                                        })
+                                    except Exception as e:
+                                        conversation_store.append({
+                                            "role": "tool",
+                                            "tool_call_id": tool_call_id,
+                                            "name": tool_name,
+                                            "content": json.dumps({"error": str(e)})
+                                        })
                                 
-                                assistant_message = response['message']
-                                conversation_history.append(assistant_message)
+                                # Get final response from Ollama after tool execution
+                                final_response_obj = await chat(conversation_history, request_tools)
+                                final_assistant_text = final_response_obj['message']['content']
+                                response_queue.put(final_assistant_text)
+                                conversation_store.append(final_response_obj['message'])
                                 
-                                if assistant_message.get('tool_calls'):
-                                    response_queue.put("Using tools to help you...")
-                                    for tool_call in assistant_message['tool_calls']:
-                                        tool_name = tool_call['function']['name']
-                                        tool_args_from_llm = tool_call['function']['arguments']
-                                        tool_call_id = tool_call.get('id', f"tool_{len(conversation_history)}")
-
-                                        # Map arguments if necessary
-                                        tool_args_for_server = tool_args_from_llm.copy()
-                                        if tool_name == "calculate_bmi":
-                                            if "weight" in tool_args_for_server and "weight_kg" not in tool_args_for_server:
-                                                tool_args_for_server["weight_kg"] = tool_args_for_server.pop("weight")
-                                            if "height" in tool_args_for_server and "height_m" not in tool_args_for_server:
-                                                tool_args_for_server["height_m"] = tool_args_for_server.pop("height")
-
-                                        try:
-                                            tool_call_response_object = await session.call_tool(tool_name, arguments=tool_args_for_server)
-                                            
-                                            if hasattr(tool_call_response_object, 'error') and tool_call_response_object.error:
-                                                error_content = tool_call_response_object.error
-                                                actual_tool_output_for_llm = {"error": error_content}
-                                            elif hasattr(tool_call_response_object, 'result'):
-                                                actual_tool_output_for_llm = tool_call_response_object.result
-                                            elif hasattr(tool_call_response_object, 'content') and \
-                                                    isinstance(tool_call_response_object.content, list) and \
-                                                    len(tool_call_response_object.content) > 0 and \
-                                                    hasattr(tool_call_response_object.content[0], 'text') and \
-                                                    getattr(tool_call_response_object.content[0], 'type', None) == 'text':
-                                                actual_tool_output_for_llm = tool_call_response_object.content[0].text
-                                            else:
-                                                actual_tool_output_for_llm = str(tool_call_response_object)
-
-                                            conversation_history.append({
-                                                "role": "tool",
-                                                "tool_call_id": tool_call_id, 
-                                                "name": tool_name,
-                                                "content": json.dumps(actual_tool_output_for_llm) 
-                                            })
-                                        except Exception as e:
-                                            conversation_history.append({
-                                                "role": "tool",
-                                                "tool_call_id": tool_call_id,
-                                                "name": tool_name,
-                                                "content": json.dumps({"error": str(e)})
-                                            })
-                                    
-                                    # Get final response from Ollama after tool execution
-                                    final_response_obj = await ollama_client.chat(
-                                        model="qwen3:8b",
-                                        messages=conversation_history,
-                                        tools=ollama_tools_definition if ollama_tools_definition else None
-                                    )
-                                    final_assistant_text = final_response_obj['message']['content']
-                                    response_queue.put(final_assistant_text)
-                                    conversation_history.append(final_response_obj['message'])
-                                    
-                                else:
-                                    # No tool calls, direct response
-                                    assistant_response_text = assistant_message['content']
-                                    response_queue.put(assistant_response_text)
-                            
-                            except Exception as e:
-                                response_queue.put(f"Error during chat processing: {e}")
-                                conversation_history.append({"role": "assistant", "content": f"An error occurred: {str(e)}"})
-                    
-                    except Exception as e:
-                        response_queue.put(f"Client error: {e}")
-                        await asyncio.sleep(1)
+                            else:
+                                # No tool calls, direct response
+                                assistant_response_text = assistant_message['content']
+                                response_queue.put(assistant_response_text)
                         
+                        except Exception as e:
+                            response_queue.put(f"Error during chat processing: {e}")
+                            conversation_store.append({"role": "assistant", "content": f"An error occurred: {str(e)}"})
+                
+                except Exception as e:
+                    response_queue.put(f"Client error: {e}")
+                    await asyncio.sleep(1)
+
+            await prime_task
+            conversation_store.close()
+            logging.info(f"Prefill stats: {prefill_stats.summary()}")
+                    
     except Exception as e:
         response_queue.put(f"Failed to connect to server: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(run())
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MCP client with Ollama integration")
+    parser.add_argument("--session", help="Session id to start or continue")
+    parser.add_argument("--resume", action="store_true", help="Continue the most recent session")
+    parser.add_argument("--record", metavar="FILE", help="Record model responses, tool calls and inputs to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="Replay a recording against a local server with a stubbed model")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed factor for think and model time (0 = no waiting)")
+    parser.add_argument("--no-server", action="store_true",
+                        help="Replay against an already running server instead of starting one")
+    args = parser.parse_args()
+
+    if args.replay:
+        asyncio.run(replay_session(args.replay, speed=args.speed, start_server=not args.no_server,
+                                   record_path=args.record))
+    else:
+        if args.record:
+            start_recording(args.record)
+        session_id = args.session
+        if session_id is None and args.resume:
+            session_id = ConversationStore.latest_session_id()
+        asyncio.run(run(session_id))
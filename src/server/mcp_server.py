@@ -1,16 +1,44 @@
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 import httpx
 import asyncio
+import cProfile
+import json
 from pathlib import Path
 import os
+import pstats
+import fnmatch
+import heapq
+import math
+import re
+import time
+import mmap
+import ctypes
+import ctypes.util
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict
 import logging
 import click
 from starlette.applications import Starlette
-from starlette.routing import Mount
-from starlette.types import Scope, Receive, Send
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 import uvicorn
 import contextlib
-from typing import AsyncIterator
+import contextvars
+from typing import AsyncIterator, Callable, Optional
+
+try:
+    import zstandard
+except ImportError:  # optional, responses fall back to gzip
+    zstandard = None
 
 # Configure logging
 logging.basicConfig(
@@ -21,12 +49,257 @@ logger = logging.getLogger(__name__)
 
 mcp = FastMCP("Python360")
 
+MCP_TRANSPORTS = ("sse", "streamable-http")
+
+# Worker threads used by batch_operations to run independent operations in parallel
+BATCH_MAX_WORKERS = 8
+
+# Upper bound on the number of bytes a single read_text_file call returns.
+# Larger files are read in several calls using 'next_offset' / 'next_line'.
+MAX_READ_CHUNK_BYTES = 256 * 1024
+
+
+# --- Directory Listing Cache ---
+
+# inotify event bits (see <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+
+class InotifyWatcher:
+    """
+    Minimal ctypes binding to Linux inotify. Calls on_event(wd, mask) from a
+    background thread for every event on a watched directory.
+    """
+
+    WATCH_MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+        | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    )
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, on_event: Callable[[int, int], None]):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._on_event = on_event
+        self._thread = threading.Thread(target=self._read_events, name="inotify-watcher", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def create(cls, on_event: Callable[[int, int], None]) -> Optional["InotifyWatcher"]:
+        """Returns a watcher, or None where inotify is not available (non-Linux systems)."""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            return cls(on_event)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify unavailable, listing cache falls back to mtime checks: {e}")
+            return None
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def remove_watch(self, wd: int) -> None:
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self) -> None:
+        header_size = self._EVENT_HEADER.size
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                logger.error(f"inotify read failed, stopping watcher: {e}")
+                return
+            pos = 0
+            while pos + header_size <= len(data):
+                wd, mask, _cookie, name_len = self._EVENT_HEADER.unpack_from(data, pos)
+                pos += header_size + name_len
+                self._on_event(wd, mask)
+
+
+class _CachedListing:
+    __slots__ = ("listing", "mtime_ns", "wd")
+
+    def __init__(self, listing: dict, mtime_ns: int, wd: Optional[int]):
+        self.listing = listing
+        self.mtime_ns = mtime_ns
+        self.wd = wd
+
+
+class DirectoryListingCache:
+    """
+    LRU cache of directory listings keyed by resolved path.
+
+    Entries are invalidated as soon as inotify reports a change in the directory.
+    At most max_watches directories are watched at a time; the least recently used
+    watch is dropped when the limit is reached (or the kernel runs out of watches),
+    and entries without a watch are validated against the directory mtime instead.
+    """
+
+    def __init__(self, max_entries: int = 256, max_watches: int = 128):
+        self.max_entries = max_entries
+        self.max_watches = max_watches
+        self._entries: "OrderedDict[str, _CachedListing]" = OrderedDict()
+        self._watches: "OrderedDict[str, int]" = OrderedDict()
+        self._wd_paths: dict = {}
+        self._loading: dict = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._watcher_started = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get_or_load(self, path: str, loader: Callable[[], dict], needs_watch: bool = False) -> dict:
+        """
+        Returns the cached listing for path, calling loader() to build it on a miss.
+        With needs_watch the cached listing is only used while the directory is watched:
+        file sizes and mtimes change without touching the directory's own mtime, so only
+        inotify events (IN_MODIFY / IN_ATTRIB) keep such listings fresh.
+        """
+        if self.max_entries <= 0:
+            return loader()
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.wd is None and (needs_watch or self._mtime_ns(path) != entry.mtime_ns):
+                del self._entries[path]
+                self.invalidations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(path)
+                if path in self._watches:
+                    self._watches.move_to_end(path)
+                self.hits += 1
+                return entry.listing
+            self.misses += 1
+            # Watch before reading so that changes made during the read are not missed
+            self._watch(path)
+            self._loading[path] = False
+
+        try:
+            mtime_ns = self._mtime_ns(path)
+            listing = loader()
+        finally:
+            with self._lock:
+                changed_while_loading = self._loading.pop(path, True)
+
+        with self._lock:
+            if not changed_while_loading:
+                self._entries[path] = _CachedListing(listing, mtime_ns, self._watches.get(path))
+                self._entries.move_to_end(path)
+                while len(self._entries) > self.max_entries:
+                    evicted_path, _ = self._entries.popitem(last=False)
+                    self._unwatch(evicted_path)
+                    self.evictions += 1
+        return listing
+
+    def invalidate(self, path: str) -> None:
+        """Drops the cached listing for path, e.g. after the server changed the directory itself."""
+        with self._lock:
+            self._drop(path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "watches": len(self._watches),
+                "inotify": self._watcher is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+    @staticmethod
+    def _mtime_ns(path: str) -> int:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return -1
+
+    def _drop(self, path: str) -> None:
+        if path in self._loading:
+            self._loading[path] = True
+        if self._entries.pop(path, None) is not None:
+            self.invalidations += 1
+
+    def _watch(self, path: str) -> Optional[int]:
+        if not self._watcher_started:
+            self._watcher_started = True
+            self._watcher = InotifyWatcher.create(self._on_event)
+        if self._watcher is None or self.max_watches <= 0:
+            return None
+        if path in self._watches:
+            self._watches.move_to_end(path)
+            return self._watches[path]
+        if len(self._watches) >= self.max_watches:
+            self._unwatch(next(iter(self._watches)))
+        try:
+            wd = self._watcher.add_watch(path)
+        except OSError as e:
+            # ENOSPC once the kernel watch limit is reached; fall back to mtime checks
+            logger.debug(f"Could not watch {path}: {e}")
+            return None
+        self._watches[path] = wd
+        self._wd_paths[wd] = path
+        return wd
+
+    def _unwatch(self, path: str) -> None:
+        wd = self._watches.pop(path, None)
+        if wd is None:
+            return
+        self._wd_paths.pop(wd, None)
+        entry = self._entries.get(path)
+        if entry is not None:
+            entry.wd = None
+        self._watcher.remove_watch(wd)
+
+    def _on_event(self, wd: int, mask: int) -> None:
+        with self._lock:
+            path = self._wd_paths.get(wd)
+            if path is None:
+                return
+            self._drop(path)
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # The directory itself is gone; the kernel drops the watch
+                self._wd_paths.pop(wd, None)
+                self._watches.pop(path, None)
+
+
+listing_cache = DirectoryListingCache()
+
 
 # --- Generic Tools ---
 
+# Canned fetch_weather bodies keyed by "latitude,longitude" (set with --weather-stub),
+# so recorded sessions can be replayed without calling the real API
+weather_stub: Optional[dict] = None
+
+
 @mcp.tool()
 async def fetch_weather(latitude: float, longitude: float) -> str:
     """Fetch current weather for a location using latitude and longitude"""
+    if weather_stub is not None:
+        return weather_stub.get(f"{float(latitude)},{float(longitude)}", '{"error": "No stubbed weather for this location"}')
     url = (
         f"https://api.open-meteo.com/v1/forecast?"
         f"latitude={latitude}&longitude={longitude}&current=temperature_2m"
@@ -40,36 +313,120 @@ async def fetch_weather(latitude: float, longitude: float) -> str:
 
 # --- File System Tools ---
 
+LISTING_SORT_KEYS = ("name", "size", "mtime")
+
+
+def scan_directory(path: str, include_metadata: bool = False) -> dict:
+    """
+    Reads a directory in a single os.scandir pass.
+    File/directory classification uses the type information cached on each DirEntry,
+    so no extra stat calls are made unless include_metadata is set; in that case each
+    entry is stat'ed once (DirEntry caches the result).
+    Returns {'files': [...], 'directories': [...], 'metadata': bool} where every item is
+    a (name, is_symlink, size, mtime) tuple; size and mtime are None without metadata.
+    """
+    files = []
+    directories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+                is_file = not is_dir and entry.is_file()
+                if not (is_dir or is_file):
+                    # Broken symlinks, sockets, devices...
+                    continue
+                is_symlink = entry.is_symlink()
+                if include_metadata:
+                    st = entry.stat()
+                    item = (entry.name, is_symlink, st.st_size, st.st_mtime)
+                else:
+                    item = (entry.name, is_symlink, None, None)
+            except OSError:
+                # Entry vanished or cannot be stat'ed while scanning
+                continue
+            (directories if is_dir else files).append(item)
+    return {"files": files, "directories": directories, "metadata": include_metadata}
+
+
+def _format_listing_items(items: list, include_metadata: bool, sort_by: Optional[str],
+                          descending: bool, name_filter: Optional[str]) -> list:
+    if name_filter:
+        items = [item for item in items if fnmatch.fnmatch(item[0].lower(), name_filter.lower())]
+    if sort_by == "name":
+        items = sorted(items, key=lambda item: item[0].lower(), reverse=descending)
+    elif sort_by == "size":
+        items = sorted(items, key=lambda item: item[2], reverse=descending)
+    elif sort_by == "mtime":
+        items = sorted(items, key=lambda item: item[3], reverse=descending)
+    if not include_metadata:
+        return [item[0] for item in items]
+    return [
+        {"name": name, "size": size, "mtime": mtime, "is_symlink": is_symlink}
+        for name, is_symlink, size, mtime in items
+    ]
+
+
 @mcp.tool()
-def list_items(path: str) -> dict:
+def list_items(
+    path: str,
+    include_metadata: bool = False,
+    sort_by: Optional[str] = None,
+    descending: bool = False,
+    name_filter: Optional[str] = None,
+) -> dict:
     """
     Lists files and folders in a given directory path.
+    Set include_metadata to get size, mtime and symlink flag for every entry.
+    sort_by can be 'name', 'size' or 'mtime' (size/mtime need include_metadata), and
+    name_filter is a case-insensitive glob pattern such as '*.py'.
     Returns a dictionary with 'files' and 'directories' lists, or an 'error' message.
     """
     try:
+        if sort_by is not None and sort_by not in LISTING_SORT_KEYS:
+            return {"error": f"Invalid sort_by: {sort_by}. Expected one of {', '.join(LISTING_SORT_KEYS)}"}
+        if sort_by in ("size", "mtime") and not include_metadata:
+            return {"error": f"sort_by='{sort_by}' requires include_metadata=true"}
+
         target_path = Path(path)
         if not target_path.exists():
             return {"error": f"Path not found: {path}"}
         if not target_path.is_dir():
             return {"error": f"Path is not a directory: {path}"}
 
-        items = os.listdir(target_path)
-        files = [item for item in items if (target_path / item).is_file()]
-        directories = [item for item in items if (target_path / item).is_dir()]
-        
-        return {"files": files, "directories": directories, "path": str(target_path)}
+        cache_key = str(target_path.resolve())
+
+        def load() -> dict:
+            return scan_directory(cache_key, include_metadata)
+
+        listing = listing_cache.get_or_load(cache_key, load, needs_watch=include_metadata)
+        if include_metadata and not listing["metadata"]:
+            # Cached without metadata, rescan once and keep the richer listing
+            listing_cache.invalidate(cache_key)
+            listing = listing_cache.get_or_load(cache_key, load, needs_watch=True)
+
+        return {
+            "files": _format_listing_items(listing["files"], include_metadata, sort_by, descending, name_filter),
+            "directories": _format_listing_items(listing["directories"], include_metadata, sort_by, descending, name_filter),
+            "path": str(target_path),
+        }
     except PermissionError:
         return {"error": f"Permission denied for path: {path}"}
     except Exception as e:
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
 @mcp.tool()
-def create_text_file(file_path: str, content: str) -> dict:
+def create_text_file(file_path: str, content: str, mode: str = "create") -> dict:
     """
     Creates a new file with the given text content at the specified path.
+    With mode="append" the content is appended to an existing file instead, so large
+    files can be written in several smaller chunks: create with the first chunk,
+    then append the rest.
     Returns a success message or an error message.
     """
     try:
+        if mode not in ("create", "append"):
+            return {"error": f"Invalid mode: {mode}. Expected 'create' or 'append'"}
+
         target_file_path = Path(file_path)
         
         parent_dir = target_file_path.parent
@@ -78,17 +435,153 @@ def create_text_file(file_path: str, content: str) -> dict:
         if not parent_dir.is_dir():
             return {"error": f"Parent path is not a directory: {parent_dir}"}
         
+        if mode == "append":
+            if not target_file_path.exists():
+                return {"error": f"File not found for append: {file_path}"}
+            if not target_file_path.is_file():
+                return {"error": f"Path is not a file: {file_path}"}
+
+            with open(target_file_path, 'a', encoding='utf-8') as f:
+                f.write(content)
+                size = f.tell()
+            listing_cache.invalidate(str(parent_dir.resolve()))
+            return {"success": True, "message": f"Content appended: {file_path}", "size": size}
+
         if target_file_path.exists():
             return {"error": f"File already exists: {file_path}"}
 
         with open(target_file_path, 'w', encoding='utf-8') as f:
             f.write(content)
+        listing_cache.invalidate(str(parent_dir.resolve()))
+        invalidate_search_indexes(str(target_file_path.resolve()))
         return {"success": True, "message": f"File created: {file_path}"}
     except PermissionError:
         return {"error": f"Permission denied for path: {file_path}"}
     except Exception as e:
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
+def _utf8_boundary(mm: mmap.mmap, pos: int, size: int) -> int:
+    """Moves pos backwards until it no longer points into the middle of a UTF-8 character."""
+    while 0 < pos < size and (mm[pos] & 0xC0) == 0x80:
+        pos -= 1
+    return pos
+
+
+def _utf8_char_end(mm: mmap.mmap, pos: int, size: int) -> int:
+    """Returns the offset just after the UTF-8 character starting at pos."""
+    pos += 1
+    while pos < size and (mm[pos] & 0xC0) == 0x80:
+        pos += 1
+    return pos
+
+
+def _line_start(mm: mmap.mmap, line_number: int, size: int, pos: int = 0, pos_line: int = 1) -> int:
+    """Returns the byte offset at which the given 1-based line starts, scanning from pos (the start of pos_line)."""
+    for _ in range(line_number - pos_line):
+        newline = mm.find(b"\n", pos)
+        if newline == -1:
+            return size
+        pos = newline + 1
+    return pos
+
+
+@mcp.tool()
+def read_text_file(
+    file_path: str,
+    offset: int = 0,
+    length: int = MAX_READ_CHUNK_BYTES,
+    start_line: Optional[int] = None,
+    end_line: Optional[int] = None,
+) -> dict:
+    """
+    Reads part of a text file, either a byte range (offset/length) or, when start_line
+    is given, a range of lines (1-based, end_line inclusive).
+    At most MAX_READ_CHUNK_BYTES are returned per call, but always at least one whole
+    character; continue from 'next_offset' (or 'next_line') until 'eof' is true. In line
+    mode, pass the 'next_offset' returned with 'next_line' as offset, so the file is not
+    scanned from the start again. A line longer than the limit is returned in parts,
+    marked 'partial_line'; their 'next_line' is the same line, continued at 'next_offset'.
+    Returns a dictionary with the 'content' and range information, or an 'error' message.
+    """
+    try:
+        target_file_path = Path(file_path)
+        if not target_file_path.exists():
+            return {"error": f"File not found: {file_path}"}
+        if not target_file_path.is_file():
+            return {"error": f"Path is not a file: {file_path}"}
+        if offset < 0 or length < 0:
+            return {"error": "offset and length must not be negative"}
+        if start_line is not None and start_line < 1:
+            return {"error": "start_line must be 1 or greater"}
+        if end_line is not None and start_line is not None and end_line < start_line:
+            return {"error": "end_line must not be smaller than start_line"}
+
+        length = min(length, MAX_READ_CHUNK_BYTES)
+
+        with open(target_file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                # mmap cannot map empty files
+                return {"path": str(target_file_path), "content": "", "offset": 0,
+                        "next_offset": 0, "size": 0, "eof": True}
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                result = {"path": str(target_file_path), "size": size}
+
+                if start_line is not None:
+                    if offset:
+                        # offset is where start_line begins or, after a partial line, continues,
+                        # as returned in 'next_offset'
+                        if offset > size or (offset < size and (mm[offset] & 0xC0) == 0x80):
+                            return {"error": "With start_line, offset must be the 'next_offset' returned with 'next_line'"}
+                        start = offset
+                    else:
+                        start = _line_start(mm, start_line, size)
+                    limit = min(start + length, size)
+                    end = start
+                    line = start_line
+                    # Take whole lines until end_line or the byte limit is reached
+                    while end < limit and (end_line is None or line <= end_line):
+                        newline = mm.find(b"\n", end, limit)
+                        if newline == -1:
+                            if limit == size:
+                                end = size
+                                line += 1
+                            break
+                        end = newline + 1
+                        line += 1
+                    if end == start and start < size:
+                        # A single line longer than the limit, return its next part
+                        end = _utf8_boundary(mm, limit, size)
+                        if end <= start:
+                            end = _utf8_char_end(mm, start, size)
+                        result["partial_line"] = True
+                        line = start_line
+                    result["next_line"] = line
+                    result["start_line"] = start_line
+                else:
+                    start = _utf8_boundary(mm, min(offset, size), size)
+                    end = _utf8_boundary(mm, min(start + length, size), size)
+                    if end <= start < size:
+                        # length is shorter than the character at start, return that character
+                        end = _utf8_char_end(mm, start, size)
+
+                # Decode straight from the mapped pages, without an intermediate bytes copy
+                with memoryview(mm) as view, view[start:end] as chunk:
+                    content = str(chunk, 'utf-8', 'replace')
+
+                result.update({
+                    "content": content,
+                    "offset": start,
+                    "next_offset": end,
+                    "eof": end >= size or (end_line is not None and result.get("next_line", 0) > end_line),
+                })
+                return result
+    except PermissionError:
+        return {"error": f"Permission denied for path: {file_path}"}
+    except Exception as e:
+        return {"error": f"An unexpected error occurred: {str(e)}"}
+
 @mcp.tool()
 def create_directory(directory_path: str) -> dict:
     """
@@ -111,6 +604,8 @@ def create_directory(directory_path: str) -> dict:
              return {"error": f"Parent path is not a directory: {parent_dir}"}
 
         os.makedirs(target_dir_path, exist_ok=False)
+        listing_cache.invalidate(str(parent_dir.resolve()))
+        invalidate_search_indexes(str(target_dir_path.resolve()))
         return {"success": True, "message": f"Directory created: {directory_path}"}
     except PermissionError:
         return {"error": f"Permission denied for path: {directory_path}"}
@@ -119,13 +614,497 @@ def create_directory(directory_path: str) -> dict:
     except Exception as e:
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
+BATCH_OPERATIONS = ("create_directory", "create_text_file")
+
+
+def _validate_batch(operations: list) -> tuple:
+    """
+    Checks every operation before anything is executed and works out the order.
+    Returns (levels, parents, errors): levels maps operation index -> wave number,
+    where an operation runs one wave after the directory operation that creates its
+    parent; parents maps operation index -> index of that parent operation (if any);
+    errors maps operation index -> error message.
+    """
+    errors = {}
+    targets = {}  # resolved path -> operation index
+    for i, op in enumerate(operations):
+        if not isinstance(op, dict):
+            errors[i] = "Operation must be an object"
+            continue
+        kind = op.get("op")
+        op_path = op.get("path")
+        if kind not in BATCH_OPERATIONS:
+            errors[i] = f"Invalid op: {kind}. Expected one of {', '.join(BATCH_OPERATIONS)}"
+        elif not isinstance(op_path, str) or not op_path:
+            errors[i] = "Missing 'path'"
+        elif kind == "create_text_file" and not isinstance(op.get("content", ""), str):
+            errors[i] = "'content' must be a string"
+        else:
+            resolved = str(Path(op_path).resolve())
+            if resolved in targets:
+                errors[i] = f"Duplicate path in batch: {op_path}"
+            elif os.path.lexists(resolved):
+                errors[i] = f"Path already exists: {op_path}"
+            else:
+                targets[resolved] = i
+
+    levels = {}
+    parents = {}
+
+    def level_of(i: int, resolved: str) -> Optional[int]:
+        if i in levels:
+            return levels[i]
+        parent = os.path.dirname(resolved)
+        parent_op = targets.get(parent)
+        if parent_op is not None:
+            if operations[parent_op]["op"] != "create_directory":
+                errors[i] = f"Parent path is created as a file: {parent}"
+                return None
+            parent_level = level_of(parent_op, parent)
+            if parent_level is None:
+                errors[i] = f"Parent directory operation failed validation: {parent}"
+                return None
+            levels[i] = parent_level + 1
+            parents[i] = parent_op
+        elif os.path.isdir(parent):
+            levels[i] = 0
+        else:
+            errors[i] = f"Parent directory does not exist: {parent}"
+            return None
+        return levels[i]
+
+    for resolved, i in targets.items():
+        if i not in errors:
+            level_of(i, resolved)
+    return levels, parents, errors
+
+
+def _rollback_batch(operations: list, completed: list) -> None:
+    """Removes what a batch created, children before parents."""
+    for i in sorted(completed, key=lambda i: -len(Path(operations[i]["path"]).resolve().parts)):
+        target = Path(operations[i]["path"])
+        try:
+            if operations[i]["op"] == "create_directory":
+                target.rmdir()
+            else:
+                target.unlink()
+            listing_cache.invalidate(str(target.parent.resolve()))
+            invalidate_search_indexes(str(target.resolve()))
+        except OSError as e:
+            logger.warning(f"Rollback could not remove {target}: {e}")
+
+
 @mcp.tool()
-def search_items(path: str, search_query: str) -> dict:
+def batch_operations(operations: list[dict], atomic: bool = False) -> dict:
+    """
+    Runs many create_directory / create_text_file operations in a single call.
+    Each operation is {"op": "create_directory", "path": ...} or
+    {"op": "create_text_file", "path": ..., "content": ...}. Directories created in the
+    same batch may be used as parents; independent operations run in parallel.
+    With atomic=true nothing is done if any operation is invalid, and everything
+    already created is removed again if one fails.
+    Returns per-operation 'results' in input order, or an 'error' message.
+    """
+    try:
+        levels, parents, errors = _validate_batch(operations)
+        results = [None] * len(operations)
+        for i, message in errors.items():
+            results[i] = {"index": i, "error": message}
+
+        if atomic and errors:
+            for i in levels:
+                results[i] = {"index": i, "error": "Not executed, batch rejected by validation"}
+            return {"success": False, "atomic": True, "results": results}
+
+        waves = {}
+        for i, level in levels.items():
+            waves.setdefault(level, []).append(i)
+
+        def run(i: int) -> dict:
+            op = operations[i]
+            if op["op"] == "create_directory":
+                return create_directory(op["path"])
+            return create_text_file(op["path"], op.get("content", ""))
+
+        completed = []
+        failed = False
+        with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as executor:
+            for level in sorted(waves):
+                wave = []
+                for i in waves[level]:
+                    parent_op = parents.get(i)
+                    if parent_op is not None and not results[parent_op].get("success"):
+                        results[i] = {"index": i, "error": "Not executed, parent directory operation failed"}
+                    else:
+                        wave.append(i)
+                for i, result in zip(wave, executor.map(run, wave)):
+                    results[i] = {"index": i, **result}
+                    if result.get("success"):
+                        completed.append(i)
+                    else:
+                        failed = True
+                if failed and atomic:
+                    break
+
+        # Operations whose parent failed (or was never run) are reported as skipped
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = {"index": i, "error": "Not executed, an earlier operation failed"}
+
+        if failed and atomic:
+            _rollback_batch(operations, completed)
+            for i in completed:
+                results[i]["rolled_back"] = True
+            return {"success": False, "atomic": True, "rolled_back": True, "results": results}
+
+        return {"success": not failed and not errors, "atomic": atomic, "results": results}
+    except Exception as e:
+        return {"error": f"An unexpected error occurred: {str(e)}"}
+
+
+# --- Deadlines and Cancellation ---
+
+class CancelToken:
+    """
+    Stop signal checked by long-running walks between directories. It fires when the
+    request's deadline passes or when cancel() is called, e.g. because the client sent
+    a cancellation notification; the walk then returns what it found so far.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        if self.reason is None:
+            self.reason = reason
+
+    def should_stop(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "deadline"
+        return self.reason is not None
+
+
+def request_timeout(ctx: Optional[Context]) -> Optional[float]:
+    """Returns the deadline the client sent as '_meta': {'timeout': seconds} with the call, if any"""
+    try:
+        meta = ctx.request_context.meta if ctx is not None else None
+    except ValueError:
+        # Called in process (e.g. through mcp.call_tool), outside of any request
+        return None
+    timeout = getattr(meta, "timeout", None) if meta is not None else None
+    try:
+        return max(0.0, float(timeout)) if timeout is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+# Set by ToolProfiler around profiled tool calls, so work they hand to worker threads is profiled too
+profiled_call: "contextvars.ContextVar[Optional[dict]]" = contextvars.ContextVar("profiled_call", default=None)
+
+
+async def run_cancellable(func: Callable, *args, timeout: Optional[float] = None):
+    """
+    Runs func(*args, cancel_token) in a worker thread, so the event loop stays free to
+    process cancellation notifications while it works. If the request is cancelled,
+    the token tells func to stop at its next check.
+    """
+    cancel = CancelToken(timeout)
+    try:
+        return await asyncio.to_thread(_run_worker_call, func, *args, cancel)
+    except asyncio.CancelledError:
+        cancel.cancel()
+        raise
+
+
+def _run_worker_call(func: Callable, *args):
+    session = profiled_call.get()
+    if session is None:
+        # A deterministic window session profiles the event loop thread only, so it
+        # needs a profiler in this thread as well; sampling windows see every thread
+        session = tool_profiler.active
+        if session is None or session["tool"] is not None or session["profile"] is None:
+            return func(*args)
+    return tool_profiler.run_worker_call(session, func, args)
+
+
+# --- Name Matching and Search Index ---
+
+SEARCH_MATCH_MODES = ("substring", "glob", "regex", "fuzzy")
+# Minimum share of the query's trigrams a name must contain to count as a fuzzy match
+FUZZY_MIN_SCORE = 0.5
+# Indexes older than this are rebuilt; bounds staleness for changes made outside the server
+SEARCH_INDEX_TTL = 300.0
+SEARCH_INDEX_MAX_ROOTS = 4
+
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameMatcher:
+    """
+    Matches names against a search query. The query is compiled once per search;
+    score(lowered_name) returns a relevance in (0, 1] or None if the name does not match.
+    Raises ValueError for an unknown mode and re.error for an invalid regex.
+    """
+
+    def __init__(self, query: str, mode: str = "substring"):
+        if mode not in SEARCH_MATCH_MODES:
+            raise ValueError(f"Invalid match_mode: {mode}. Expected one of {', '.join(SEARCH_MATCH_MODES)}")
+        self.query = query.lower()
+        self.trigrams = _trigrams(self.query)
+        if mode == "fuzzy" and not self.trigrams:
+            # Too short to compare trigrams, plain substring matching is the best we can do
+            mode = "substring"
+        self.mode = mode
+        if mode == "glob":
+            self._pattern = re.compile(fnmatch.translate(self.query))
+        elif mode == "regex":
+            self._pattern = re.compile(query, re.IGNORECASE)
+        self.score = getattr(self, f"_score_{mode}")
+
+    def _score_substring(self, name: str) -> Optional[float]:
+        pos = name.find(self.query)
+        if pos < 0:
+            return None
+        coverage = len(self.query) / len(name) if name else 1.0
+        # Prefix matches rank above matches in the middle of the name
+        return (0.6 if pos == 0 else 0.2) + 0.4 * coverage
+
+    def _score_glob(self, name: str) -> Optional[float]:
+        return 1.0 if self._pattern.match(name) else None
+
+    def _score_regex(self, name: str) -> Optional[float]:
+        match = self._pattern.search(name)
+        if match is None:
+            return None
+        return 0.5 + 0.5 * (match.end() - match.start()) / max(len(name), 1)
+
+    def _score_fuzzy(self, name: str) -> Optional[float]:
+        name_trigrams = _trigrams(name)
+        shared = len(self.trigrams & name_trigrams)
+        containment = shared / len(self.trigrams)
+        if containment < FUZZY_MIN_SCORE:
+            return None
+        dice = 2 * shared / (len(self.trigrams) + len(name_trigrams))
+        return 0.8 * containment + 0.2 * dice
+
+
+class SearchIndex:
+    """
+    In-memory trigram index over every file and directory name below root.
+    Substring queries intersect the posting lists of the query's trigrams and fuzzy
+    queries count shared trigrams, so only candidate names are scored instead of
+    every name in the tree.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.built_at = time.monotonic()
+        self.parents = []  # directory paths relative to root
+        self.entries = []  # (name, parent id, is_dir)
+        self.postings = {}  # trigram -> array of entry ids
+
+        for dir_path, dirs, files_in_dir in os.walk(root):
+            parent_id = len(self.parents)
+            self.parents.append(os.path.relpath(dir_path, root) if dir_path != root else "")
+            for names, is_dir in ((dirs, True), (files_in_dir, False)):
+                for name in names:
+                    entry_id = len(self.entries)
+                    self.entries.append((name, parent_id, is_dir))
+                    for trigram in _trigrams(name.lower()):
+                        posting = self.postings.get(trigram)
+                        if posting is None:
+                            posting = self.postings[trigram] = array("I")
+                        posting.append(entry_id)
+
+    def candidates(self, matcher: NameMatcher):
+        """Returns the ids of entries that may match, in index order."""
+        if matcher.mode == "substring" and matcher.trigrams:
+            postings = sorted((self.postings.get(t, ()) for t in matcher.trigrams), key=len)
+            result = set(postings[0])
+            for posting in postings[1:]:
+                if not result:
+                    break
+                result.intersection_update(posting)
+            return sorted(result)
+        if matcher.mode == "fuzzy":
+            counts = Counter()
+            for trigram in matcher.trigrams:
+                counts.update(self.postings.get(trigram, ()))
+            needed = math.ceil(FUZZY_MIN_SCORE * len(matcher.trigrams))
+            return sorted(entry_id for entry_id, count in counts.items() if count >= needed)
+        # Short substrings, globs and regexes: scan the names, but still without touching the disk
+        return range(len(self.entries))
+
+
+_search_indexes: "OrderedDict[str, SearchIndex]" = OrderedDict()
+_search_indexes_lock = threading.Lock()
+
+
+def get_search_index(root: str) -> SearchIndex:
+    """Returns a fresh enough index for the resolved root, building it if needed."""
+    with _search_indexes_lock:
+        index = _search_indexes.get(root)
+        if index is not None and time.monotonic() - index.built_at < SEARCH_INDEX_TTL:
+            _search_indexes.move_to_end(root)
+            return index
+
+    index = SearchIndex(root)
+    with _search_indexes_lock:
+        _search_indexes[root] = index
+        _search_indexes.move_to_end(root)
+        while len(_search_indexes) > SEARCH_INDEX_MAX_ROOTS:
+            _search_indexes.popitem(last=False)
+    return index
+
+
+def invalidate_search_indexes(path: str) -> None:
+    """Drops every index whose tree contains the resolved path."""
+    with _search_indexes_lock:
+        for root in list(_search_indexes):
+            if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+                del _search_indexes[root]
+
+
+SEARCH_RESULT_FORMATS = ("flat", "tree")
+# Orders for ranked searches: best match score, shallowest path, most recently modified
+SEARCH_RANK_KEYS = ("quality", "depth", "recency")
+# Matches kept by a ranked search when max_results is not given
+SEARCH_DEFAULT_TOP_K = 100
+
+
+class TopKMatches:
+    """
+    Keeps the k best matches seen so far in a min-heap, so a ranked search needs
+    O(k) memory however many entries match. Equally ranked matches keep walk order.
+    """
+
+    def __init__(self, k: int, rank_by: str):
+        self.k = k
+        self.rank_by = rank_by
+        self._heap = []
+        self._seen = 0
+
+    def add(self, score: float, match_path: str, is_dir: bool, depth: int) -> None:
+        if self.rank_by == "quality":
+            key = (score,)
+        elif self.rank_by == "depth":
+            key = (-depth, score)
+        else:
+            try:
+                key = (os.stat(match_path, follow_symlinks=False).st_mtime, score)
+            except OSError:
+                return
+        self._seen += 1
+        item = (key, -self._seen, score, match_path, is_dir)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def results(self) -> tuple:
+        """Returns (file_matches, directory_matches) as (score, path) lists, best first"""
+        files, directories = [], []
+        for _, _, score, match_path, is_dir in sorted(self._heap, reverse=True):
+            (directories if is_dir else files).append((score, match_path))
+        return files, directories
+
+
+def encode_path_tree(matches: list, root: str) -> dict:
+    """
+    Encodes (score, path) matches below root as a prefix tree of path components
+    relative to root, so the shared leading directories are sent only once.
+    A matched path maps to its score; a directory node is a dict of its children,
+    with the key "." holding the score when the directory itself matched too.
+    """
+    prefix = os.path.join(root, "")
+    tree = {}
+    for score, match_path in matches:
+        relative = match_path[len(prefix):] if match_path.startswith(prefix) else os.path.relpath(match_path, root)
+        *parents, name = relative.split(os.sep)
+        node = tree
+        for part in parents:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                child = node[part] = {} if child is None else {".": child}
+            node = child
+        existing = node.get(name)
+        if isinstance(existing, dict):
+            existing["."] = round(score, 3)
+        else:
+            node[name] = round(score, 3)
+    return tree
+
+
+@mcp.tool()
+async def search_items(
+    path: str,
+    search_query: str,
+    match_mode: str = "substring",
+    use_index: bool = False,
+    result_format: str = "flat",
+    max_results: Optional[int] = None,
+    max_depth: Optional[int] = None,
+    time_budget: Optional[float] = None,
+    rank_by: Optional[str] = None,
+    ctx: Context = None,
+) -> dict:
     """
     Searches for files and folders within a given path (recursively)
-    whose names contain the search_query.
+    whose names match the search_query.
+    match_mode is 'substring' (case-insensitive, the default), 'glob' (e.g. '*.py'),
+    'regex' or 'fuzzy' (tolerates typos). With use_index the names below path are kept
+    in an in-memory trigram index so repeated searches do not walk the disk again.
+    Results are ordered best match first; 'file_scores' and 'directory_scores' hold the
+    relevance of each entry.
+    With result_format='tree' the matches are returned as 'file_tree' and 'directory_tree'
+    prefix trees relative to 'searched_path' (leaves hold the scores), which is much
+    smaller for large result sets. The trees hold no order: use the flat format with
+    rank_by 'depth' or 'recency'.
+    max_depth limits how far below path the search goes (0 = only its direct entries).
+    max_results stops the search after that many matches and time_budget after that many
+    seconds; the search also stops at the call's deadline. A stopped search returns the
+    matches found so far with 'truncated' set to true.
+    With rank_by ('quality', 'depth' for the shallowest paths or 'recency' for the most
+    recently modified) the whole tree is searched but only the best max_results
+    (default 100) matches are kept and returned in that order.
     Returns a dictionary with 'found_files' and 'found_directories' lists, or an 'error' message.
     """
+    deadlines = [t for t in (request_timeout(ctx), time_budget) if t is not None]
+    return await run_cancellable(find_items, path, search_query, match_mode, use_index, result_format,
+                                 max_results, max_depth, time_budget, rank_by,
+                                 timeout=min(deadlines) if deadlines else None)
+
+
+def find_items(
+    path: str,
+    search_query: str,
+    match_mode: str = "substring",
+    use_index: bool = False,
+    result_format: str = "flat",
+    max_results: Optional[int] = None,
+    max_depth: Optional[int] = None,
+    time_budget: Optional[float] = None,
+    rank_by: Optional[str] = None,
+    cancel: Optional[CancelToken] = None,
+) -> dict:
+    """Blocking implementation of search_items; stops early when cancel fires."""
+    cancel = cancel or CancelToken(time_budget)
+    if result_format not in SEARCH_RESULT_FORMATS:
+        return {"error": f"Invalid result_format: {result_format}. Expected one of {', '.join(SEARCH_RESULT_FORMATS)}"}
+    if rank_by is not None and rank_by not in SEARCH_RANK_KEYS:
+        return {"error": f"Invalid rank_by: {rank_by}. Expected one of {', '.join(SEARCH_RANK_KEYS)}"}
+    if max_results is not None and max_results < 1:
+        return {"error": "max_results must be at least 1"}
+    if max_depth is not None and max_depth < 0:
+        return {"error": "max_depth must not be negative"}
+    try:
+        matcher = NameMatcher(search_query, match_mode)
+    except (ValueError, re.error) as e:
+        return {"error": f"Invalid search query: {str(e)}"}
+
     try:
         target_path = Path(path)
         if not target_path.exists():
@@ -133,22 +1112,93 @@ def search_items(path: str, search_query: str) -> dict:
         if not target_path.is_dir():
             return {"error": f"Path is not a directory: {path}"}
 
-        found_files = []
-        found_directories = []
+        file_matches = []
+        directory_matches = []
+        top_k = TopKMatches(max_results or SEARCH_DEFAULT_TOP_K, rank_by) if rank_by is not None else None
+
+        def add_match(score: float, match_path: str, is_dir: bool, depth: int) -> None:
+            if top_k is not None:
+                top_k.add(score, match_path, is_dir, depth)
+                return
+            if max_results is not None and len(file_matches) + len(directory_matches) >= max_results:
+                # Only a match beyond max_results shows that the results are incomplete
+                cancel.cancel("max_results")
+                return
+            (directory_matches if is_dir else file_matches).append((score, match_path))
+
+        if use_index:
+            index = get_search_index(str(target_path.resolve()))
+            parent_depths = {}
+            for position, entry_id in enumerate(index.candidates(matcher)):
+                if position % 4096 == 0 and cancel.should_stop():
+                    break
+                name, parent_id, is_dir = index.entries[entry_id]
+                depth = parent_depths.get(parent_id)
+                if depth is None:
+                    parent = index.parents[parent_id]
+                    depth = parent_depths[parent_id] = parent.count(os.sep) + 1 if parent else 0
+                if max_depth is not None and depth > max_depth:
+                    continue
+                score = matcher.score(name.lower())
+                if score is not None:
+                    add_match(score, os.path.join(str(target_path), index.parents[parent_id], name), is_dir, depth)
+                    if cancel.reason is not None:
+                        break
+        else:
+            top = str(target_path)
+            prefix = os.path.join(top, "")
+            for root, dirs, files_in_dir in os.walk(target_path):
+                if cancel.should_stop():
+                    break
+                depth = 0 if root == top else root[len(prefix):].count(os.sep) + 1
+                for dirname in dirs:
+                    score = matcher.score(dirname.lower())
+                    if score is not None:
+                        add_match(score, os.path.join(root, dirname), True, depth)
+                        if cancel.reason is not None:
+                            break
+                else:
+                    for filename in files_in_dir:
+                        score = matcher.score(filename.lower())
+                        if score is not None:
+                            add_match(score, os.path.join(root, filename), False, depth)
+                            if cancel.reason is not None:
+                                break
+                if max_depth is not None and depth >= max_depth:
+                    dirs[:] = []
+
+        truncation = {"truncated": cancel.reason is not None}
+        if cancel.reason is not None:
+            truncation["truncated_reason"] = cancel.reason
+
+        if top_k is not None:
+            file_matches, directory_matches = top_k.results()
+            truncation["rank_by"] = rank_by
+        else:
+            # Stable sort: equally relevant entries keep their walk order
+            file_matches.sort(key=lambda match: -match[0])
+            directory_matches.sort(key=lambda match: -match[0])
+
+        if result_format == "tree":
+            return {
+                "searched_path": str(target_path),
+                "query": search_query,
+                "match_mode": matcher.mode,
+                "result_format": "tree",
+                "file_tree": encode_path_tree(file_matches, str(target_path)),
+                "directory_tree": encode_path_tree(directory_matches, str(target_path)),
+                **truncation,
+            }
 
-        for root, dirs, files_in_dir in os.walk(target_path):
-            for dirname in dirs:
-                if search_query.lower() in dirname.lower():
-                    found_directories.append(str(Path(root) / dirname))
-            for filename in files_in_dir:
-                if search_query.lower() in filename.lower():
-                    found_files.append(str(Path(root) / filename))
-        
         return {
             "searched_path": str(target_path),
             "query": search_query,
-            "found_files": found_files,
-            "found_directories": found_directories
+            "match_mode": matcher.mode,
+            "found_files": [match[1] for match in file_matches],
+            "found_directories": [match[1] for match in directory_matches],
+            "file_scores": [round(match[0], 3) for match in file_matches],
+            "directory_scores": [round(match[0], 3) for match in directory_matches],
+            **truncation,
         }
     except PermissionError:
         return {"error": f"Permission denied while searching in path: {path}"}
@@ -156,6 +1206,432 @@ def search_items(path: str, search_query: str) -> dict:
         return {"error": f"An unexpected error occurred during search: {str(e)}"}
 
 
+# --- Response Compression ---
+
+COMPRESSION_CHOICES = ("auto", "zstd", "gzip", "off")
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+
+
+class _StreamCompressor:
+    """Incremental gzip/zstd compressor; flush() emits everything compressed so far"""
+
+    def __init__(self, encoding: str, level: int):
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            # wbits=31 produces a gzip header and trailer
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._flush_mode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if final:
+            return self._compressor.compress(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(self._flush_mode)
+
+
+def _choose_encoding(accept_encoding: str, encodings: tuple) -> Optional[str]:
+    """
+    Picks the content coding for an Accept-Encoding header: the one of encodings (in
+    order of preference) with the highest q-value above 0, or None when the client
+    refuses all of them or prefers identity.
+    """
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        token, *params = [part.strip() for part in item.split(";")]
+        if not token:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[token] = quality
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    if best is not None and qualities.get("identity", 0.0) > best_quality:
+        return None
+    return best
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with zstd (when the zstandard package is
+    installed) or gzip, whichever the client accepts. Complete responses below
+    minimum_size are sent as they are. Streaming responses such as the SSE event
+    stream are compressed chunk by chunk and flushed after every chunk, so events are
+    not held back. Chunks of minimum_size bytes or more are compressed in a worker
+    thread to keep the event loop free.
+    """
+
+    def __init__(self, app: ASGIApp, encodings: tuple = ("zstd", "gzip"), level: Optional[int] = None,
+                 minimum_size: int = 1024):
+        self.app = app
+        self.encodings = tuple(e for e in encodings if e != "zstd" or zstandard is not None)
+        self.level = level
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = _choose_encoding(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        level = self.level if self.level is not None else DEFAULT_COMPRESSION_LEVELS[encoding]
+        start_message: Optional[Message] = None
+        compressor: Optional[_StreamCompressor] = None
+        passthrough = False
+
+        async def compress(data: bytes, final: bool) -> bytes:
+            if len(data) >= self.minimum_size:
+                return await asyncio.to_thread(compressor.compress, data, final)
+            return compressor.compress(data, final)
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                if "content-encoding" in headers or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                compressor = _StreamCompressor(encoding, level)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    if "content-length" in headers:
+                        del headers["content-length"]
+                    await send(start_message)
+                else:
+                    body = await compress(body, final=True)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+
+            await send({"type": "http.response.body", "body": await compress(body, final=not more_body),
+                        "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+# --- On-demand Profiling ---
+
+PROFILE_MODES = ("sampling", "deterministic")
+# Seconds between stack samples in sampling mode
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_DEFAULT_SECONDS = 30.0
+PROFILE_DEFAULT_CALLS = 10
+# From Python 3.12 cProfile is built on sys.monitoring: only one profiler can be enabled
+# in the process at a time, and it records calls made in every thread
+PROFILE_SHARED_ACROSS_THREADS = sys.version_info >= (3, 12)
+
+
+class _StackSampler:
+    """
+    Samples the Python stacks of the given threads (all but its own when thread_ids
+    is None) every interval seconds and counts them in collapsed-stack form, the
+    input format of flamegraph.pl, speedscope and inferno.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL, thread_ids: Optional[set] = None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, path: Path) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ToolProfiler:
+    """
+    Profiles the server on demand, either for a time window or for the next N calls
+    of one tool, with cProfile ("deterministic", written as .pstats) or the stack
+    sampler ("sampling", written as .folded collapsed stacks). Only one session runs
+    at a time. While no session is running nothing is hooked in: tool functions are
+    only wrapped for the duration of a per-tool session.
+    """
+
+    def __init__(self, output_dir: Path = Path("profiles")):
+        self.output_dir = Path(output_dir)
+        self.active: Optional[dict] = None
+        self.last_output: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def status(self) -> dict:
+        with self._lock:
+            if self.active is None:
+                return {"active": False, "last_output": self.last_output}
+            session = self.active
+            status = {key: session[key] for key in ("mode", "tool", "calls", "seconds")}
+            status["active"] = True
+            status["elapsed"] = round(time.monotonic() - session["started"], 3)
+            status["calls_done"] = session["calls_done"]
+            return status
+
+    def start(self, mode: str, seconds: Optional[float] = None, tool: Optional[str] = None,
+              calls: Optional[int] = None) -> dict:
+        """Starts a profiling session; must be called from the event loop thread"""
+        if mode not in PROFILE_MODES:
+            return {"error": f"Unknown profiling mode '{mode}'. Use one of: {', '.join(PROFILE_MODES)}"}
+        target = mcp._tool_manager.get_tool(tool) if tool is not None else None
+        if tool is not None and target is None:
+            return {"error": f"Unknown tool '{tool}'"}
+        with self._lock:
+            if self.active is not None:
+                return {"error": "A profiling session is already running"}
+            session = {
+                "mode": mode,
+                "tool": tool,
+                "calls": (calls or PROFILE_DEFAULT_CALLS) if tool is not None else None,
+                "seconds": seconds if tool is not None else (seconds or PROFILE_DEFAULT_SECONDS),
+                "started": time.monotonic(),
+                "calls_done": 0,
+                "profile": cProfile.Profile() if mode == "deterministic" else None,
+                "worker_profiles": [],
+                "profile_users": 0,
+                "sampler": None,
+                "timer": None,
+            }
+            self.active = session
+
+        if mode == "sampling":
+            # Per-tool sessions only sample threads currently inside the tool
+            session["sampler"] = _StackSampler(thread_ids=set() if tool is not None else None)
+            session["sampler"].start()
+        if tool is not None:
+            session["original_fn"] = target.fn
+            target.fn = self._wrap(target, session)
+        elif mode == "deterministic":
+            # Sync tools run on the event loop thread, which is where this is called from;
+            # work handed to worker threads is profiled by _run_worker_call
+            self._enable_profile(session)
+        if session["seconds"]:
+            session["timer"] = asyncio.get_running_loop().call_later(session["seconds"], self.stop)
+        logger.info(f"Profiling started: {mode}, " + (
+            f"next {session['calls']} calls of {tool}" if tool is not None else f"{session['seconds']} s window"))
+        return self.status()
+
+    def stop(self) -> dict:
+        """Ends the running session, writes its output and returns where it went"""
+        with self._lock:
+            session, self.active = self.active, None
+        if session is None:
+            return {"error": "No profiling session is running"}
+        if session["timer"] is not None:
+            session["timer"].cancel()
+        if session["tool"] is not None:
+            mcp._tool_manager.get_tool(session["tool"]).fn = session["original_fn"]
+        elif session["profile"] is not None:
+            self._disable_profile(session)
+
+        if session["sampler"] is not None:
+            session["sampler"].stop()
+        path = None
+        if session["tool"] is None or session["calls_done"]:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            label = f"{session['tool'] or 'window'}-{time.strftime('%Y%m%d-%H%M%S')}"
+            if session["profile"] is not None:
+                path = self.output_dir / f"{label}.pstats"
+                self._dump_profiles([session["profile"]] + session["worker_profiles"], path)
+            else:
+                path = self.output_dir / f"{label}.folded"
+                session["sampler"].dump(path)
+        self.last_output = {
+            "path": str(path) if path is not None else None,
+            "mode": session["mode"],
+            "tool": session["tool"],
+            "calls": session["calls_done"],
+            "seconds": round(time.monotonic() - session["started"], 3),
+        }
+        if session["sampler"] is not None:
+            self.last_output["samples"] = session["sampler"].samples
+        if path is not None:
+            logger.info(f"Profiling finished, output written to {path}")
+        else:
+            logger.info(f"Profiling finished without any {session['tool']} calls, nothing written")
+        return self.last_output
+
+    def _wrap(self, tool, session: dict) -> Callable:
+        """Returns a replacement for tool.fn that profiles each call and ends the session after N calls"""
+        original = session["original_fn"]
+        profile, sampler = session["profile"], session["sampler"]
+
+        def call_finished() -> None:
+            session["calls_done"] += 1
+            if session["calls_done"] >= session["calls"] and self.active is session:
+                self.stop()
+
+        if tool.is_async:
+            async def profiled(*args, **kwargs):
+                thread_id = threading.get_ident()
+                if profile is not None:
+                    self._enable_profile(session)
+                else:
+                    sampler.thread_ids.add(thread_id)
+                context_token = profiled_call.set(session)
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    profiled_call.reset(context_token)
+                    if profile is not None:
+                        self._disable_profile(session)
+                    else:
+                        sampler.thread_ids.discard(thread_id)
+                    call_finished()
+        else:
+            def profiled(*args, **kwargs):
+                thread_id = threading.get_ident()
+                try:
+                    if profile is not None:
+                        self._enable_profile(session)
+                        try:
+                            return original(*args, **kwargs)
+                        finally:
+                            self._disable_profile(session)
+                    sampler.thread_ids.add(thread_id)
+                    try:
+                        return original(*args, **kwargs)
+                    finally:
+                        sampler.thread_ids.discard(thread_id)
+                finally:
+                    call_finished()
+        return profiled
+
+    def _enable_profile(self, session: dict) -> None:
+        """
+        Enables the session's profiler for one more user. Overlapping calls share it, and
+        it stays enabled until the last of them is done, because enabling an already
+        enabled profiler fails from Python 3.12 on.
+        """
+        with self._lock:
+            session["profile_users"] += 1
+            if session["profile_users"] == 1 and self.active is session:
+                session["profile"].enable()
+
+    def _disable_profile(self, session: dict) -> None:
+        with self._lock:
+            session["profile_users"] -= 1
+            if session["profile_users"] == 0:
+                session["profile"].disable()
+
+    def run_worker_call(self, session: dict, func: Callable, args: tuple):
+        """Runs the part of a profiled tool call that was handed to a worker thread"""
+        if session["profile"] is not None and PROFILE_SHARED_ACROSS_THREADS:
+            # The session's profiler sees this thread too, it only has to stay enabled
+            self._enable_profile(session)
+            try:
+                return func(*args)
+            finally:
+                self._disable_profile(session)
+        if session["profile"] is not None:
+            # Before 3.12 a cProfile.Profile records one thread; each worker call gets its own, merged on dump
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                session["worker_profiles"].append(profile)
+        thread_id = threading.get_ident()
+        session["sampler"].thread_ids.add(thread_id)
+        try:
+            return func(*args)
+        finally:
+            session["sampler"].thread_ids.discard(thread_id)
+
+    @staticmethod
+    def _dump_profiles(profiles: list, path: Path) -> None:
+        stats = None
+        for profile in profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is None:
+            profiles[0].dump_stats(str(path))
+        else:
+            stats.dump_stats(str(path))
+
+
+tool_profiler = ToolProfiler()
+
+
+async def profile_endpoint(request: Request) -> JSONResponse:
+    """
+    Admin route for tool_profiler. GET returns the status, DELETE stops the running
+    session, POST starts one from a JSON body such as
+    {"mode": "sampling", "seconds": 10} or {"mode": "deterministic", "tool": "search_items", "calls": 5}.
+    """
+    if request.method == "GET":
+        return JSONResponse(tool_profiler.status())
+    if request.method == "DELETE":
+        result = tool_profiler.stop()
+        return JSONResponse(result, status_code=409 if "error" in result else 200)
+    try:
+        body = await request.json()
+        result = tool_profiler.start(
+            body.get("mode", "sampling"),
+            seconds=float(body["seconds"]) if body.get("seconds") is not None else None,
+            tool=body.get("tool"),
+            calls=int(body["calls"]) if body.get("calls") is not None else None,
+        )
+    except (ValueError, TypeError, AttributeError) as e:
+        return JSONResponse({"error": f"Invalid profiling request: {e}"}, status_code=400)
+    return JSONResponse(result, status_code=409 if "error" in result else 200)
+
+
+async def cache_endpoint(request: Request) -> JSONResponse:
+    """Admin route returning the hit rate and size of the directory listing cache."""
+    return JSONResponse(listing_cache.stats())
+
+
 @click.command()
 @click.option("--port", default=8085, help="Port to listen on for HTTP")
 @click.option(
@@ -166,10 +1642,99 @@ def search_items(path: str, search_query: str) -> dict:
     default="INFO",
     help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)",
 )
+@click.option(
+    "--listing-cache-size",
+    default=256,
+    help="Number of directory listings kept in memory (0 disables the cache)",
+)
+@click.option(
+    "--listing-cache-watches",
+    default=128,
+    help="Maximum number of inotify watches used to invalidate cached listings",
+)
+@click.option(
+    "--transport",
+    type=click.Choice(MCP_TRANSPORTS),
+    default="sse",
+    help="MCP transport served at /mcp",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(COMPRESSION_CHOICES),
+    default="auto",
+    help="Response compression: zstd when installed and accepted, else gzip (auto), or a fixed codec, or off",
+)
+@click.option(
+    "--compression-level",
+    type=int,
+    default=None,
+    help="Compression level (default: gzip 6, zstd 3)",
+)
+@click.option(
+    "--compression-min-size",
+    default=1024,
+    help="Responses smaller than this many bytes are sent uncompressed",
+)
+@click.option(
+    "--weather-stub",
+    "weather_stub_path",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="JSON file of canned fetch_weather responses keyed by 'latitude,longitude' (used for replays)",
+)
+@click.option(
+    "--profile",
+    "profile_mode",
+    type=click.Choice(PROFILE_MODES),
+    default=None,
+    help="Profile from startup: for --profile-seconds, or for --profile-calls calls of --profile-tool",
+)
+@click.option("--profile-tool", default=None, help="Only profile calls of this tool")
+@click.option(
+    "--profile-calls", default=PROFILE_DEFAULT_CALLS, show_default=True,
+    help="Number of --profile-tool calls to profile",
+)
+@click.option(
+    "--profile-seconds", default=None, type=float,
+    help=f"Profiling window in seconds (default {PROFILE_DEFAULT_SECONDS:g} without --profile-tool, unlimited with it)",
+)
+@click.option(
+    "--profile-dir",
+    type=click.Path(file_okay=False),
+    default="profiles",
+    show_default=True,
+    help="Directory the .pstats / .folded profiles are written to",
+)
+@click.option(
+    "--admin",
+    is_flag=True,
+    default=False,
+    help="Serve the /admin/profile route to start and stop profiling at runtime, and /admin/cache with listing cache stats",
+)
+@click.option(
+    "--stateless",
+    is_flag=True,
+    help="Streamable HTTP only: keep no per-client session state and answer with plain JSON, "
+         "so any replica behind a load balancer can serve any request",
+)
 def main(
     port: int,
     host: str,
     log_level: str,
+    listing_cache_size: int,
+    listing_cache_watches: int,
+    transport: str,
+    compression: str,
+    compression_level: Optional[int],
+    compression_min_size: int,
+    weather_stub_path: Optional[str],
+    profile_mode: Optional[str],
+    profile_tool: Optional[str],
+    profile_calls: int,
+    profile_seconds: Optional[float],
+    profile_dir: str,
+    admin: bool,
+    stateless: bool,
 ) -> int:
     # Configure logging
     logging.basicConfig(
@@ -177,25 +1742,79 @@ def main(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
 
-    # ASGI handler for MCP server
-    async def handle_mcp(scope: Scope, receive: Receive, send: Send) -> None:
-        await mcp.handle_asgi(scope, receive, send)
+    listing_cache.max_entries = listing_cache_size
+    listing_cache.max_watches = listing_cache_watches
+
+    if weather_stub_path is not None:
+        global weather_stub
+        with open(weather_stub_path, 'r', encoding='utf-8') as f:
+            weather_stub = json.load(f)
+        logger.info(f"fetch_weather answers from stub file {weather_stub_path}")
+
+    tool_profiler.output_dir = Path(profile_dir)
+
+    # Both transports are served at /mcp, clients only need to pick the matching one
+    if transport == "streamable-http":
+        mcp.settings.streamable_http_path = "/mcp"
+        mcp.settings.stateless_http = stateless
+        mcp.settings.json_response = stateless
+        mcp_app = mcp.streamable_http_app()
+    else:
+        if stateless:
+            logger.warning("--stateless only applies to the streamable-http transport, ignoring it")
+        mcp.settings.sse_path = "/mcp"
+        mcp.settings.message_path = "/mcp/messages/"
+        mcp_app = mcp.sse_app()
 
     @contextlib.asynccontextmanager
     async def lifespan(app: Starlette) -> AsyncIterator[None]:
         """Context manager for managing application lifecycle."""
-        logger.info(f"MCP Server starting on {host}:{port}")
-        try:
-            yield
-        finally:
-            logger.info("MCP Server shutting down...")
+        mode = f" ({'stateless' if stateless else 'stateful'})" if transport == "streamable-http" else ""
+        logger.info(f"MCP Server starting on {host}:{port} using {transport}{mode}")
+        async with contextlib.AsyncExitStack() as stack:
+            if transport == "streamable-http":
+                # The mounted app's own lifespan does not run, start its session manager here
+                await stack.enter_async_context(mcp.session_manager.run())
+            if profile_mode is not None:
+                result = tool_profiler.start(profile_mode, seconds=profile_seconds, tool=profile_tool,
+                                             calls=profile_calls)
+                if "error" in result:
+                    logger.error(f"Could not start profiling: {result['error']}")
+            try:
+                yield
+            finally:
+                if tool_profiler.active is not None:
+                    tool_profiler.stop()
+                logger.info(f"Directory listing cache stats: {listing_cache.stats()}")
+                logger.info("MCP Server shutting down...")
+
+    middleware = []
+    if compression != "off":
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, compressing with gzip instead")
+        encodings = {
+            "auto": ("zstd", "gzip"),
+            "zstd": ("zstd",) if zstandard is not None else ("gzip",),
+            "gzip": ("gzip",),
+        }[compression]
+        middleware.append(Middleware(
+            CompressionMiddleware,
+            encodings=encodings,
+            level=compression_level,
+            minimum_size=compression_min_size,
+        ))
+
+    routes = [Mount("/", app=mcp_app)]
+    if admin:
+        # Unauthenticated, so only enabled on request; keep the server on a trusted interface
+        routes.insert(0, Route("/admin/profile", profile_endpoint, methods=["GET", "POST", "DELETE"]))
+        routes.insert(0, Route("/admin/cache", cache_endpoint, methods=["GET"]))
 
     # Create an ASGI application using Starlette
     app = Starlette(
         debug=True,
-        routes=[
-            Mount("/mcp", app=handle_mcp),
-        ],
+        routes=routes,
+        middleware=middleware,
         lifespan=lifespan,
     )
 
@@ -8,6 +8,8 @@ import time
 import threading
 import signal
 import os
+import json
+from pathlib import Path
 
 def test_server_start():
     """Test if the server can start"""
@@ -107,6 +109,752 @@ def test_pyinstaller():
         print(f"❌ PyInstaller test error: {e}")
         return False
 
+def test_path_tree_round_trip():
+    """Test that tree-format search results decode back to the flat format"""
+    print("Testing path tree round trip...")
+    import asyncio
+    import tempfile
+    from src.server.mcp_server import encode_path_tree, search_items
+    from src.client.mcp_client import decode_compact_result, decode_path_tree
+
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "docs", "notes"))
+        os.makedirs(os.path.join(root, "report_drafts"))
+        for name in ("report.txt", os.path.join("docs", "report_v2.md"), os.path.join("docs", "notes", "old_report.txt")):
+            with open(os.path.join(root, name), "w") as f:
+                f.write("x")
+
+        # A directory that matched itself and also has matching children is kept under "."
+        matches = [
+            (0.9, os.path.join(root, "docs")),
+            (0.5, os.path.join(root, "docs", "notes", "a.txt")),
+            (0.75, os.path.join(root, "docs", "b.txt")),
+            (1.0, os.path.join(root, "c.txt")),
+        ]
+        tree = encode_path_tree(matches, root)
+        assert tree["docs"]["."] == 0.9, tree
+        decoded = decode_path_tree(tree, root)
+        assert decoded == [(path, score) for score, path in sorted(matches, reverse=True)], decoded
+        print("✅ encode_path_tree / decode_path_tree round trip")
+
+        flat = asyncio.run(search_items(root, "report"))
+        compact = asyncio.run(search_items(root, "report", result_format="tree"))
+        assert compact["result_format"] == "tree", compact
+        assert decode_compact_result(compact) == flat, (decode_compact_result(compact), flat)
+        assert decode_compact_result(flat) is flat
+        print("✅ decode_compact_result matches the flat search result")
+
+    return True
+
+def _conversation_turns(count):
+    """Builds `count` messages of user / assistant / tool turns for the store tests"""
+    roles = ["user", "assistant", "tool", "assistant"]
+    return [{"role": roles[i % len(roles)], "content": f"message {i}"} for i in range(count)]
+
+def test_conversation_store_torn_tail():
+    """Test that a session resumes after a crash left a torn index entry or record"""
+    print("Testing conversation store recovery from a torn tail...")
+    import struct
+    import tempfile
+    from src.client.mcp_client import ConversationStore
+
+    turns = _conversation_turns(5)
+    with tempfile.TemporaryDirectory() as directory:
+        store = ConversationStore("torn", directory=directory, snapshot_interval=100)
+        for message in turns:
+            store.append(message)
+        store.close()
+        log_size = os.path.getsize(store.log_path)
+        index_size = os.path.getsize(store.index_path)
+
+        # Half-written index entry
+        with open(store.index_path, "ab") as f:
+            f.write(b"\x00\x00\x00")
+        store = ConversationStore("torn", directory=directory, snapshot_interval=100)
+        assert store.count == 5 and store.messages[1:] == turns, store.messages
+        assert os.path.getsize(store.index_path) == index_size
+        store.close()
+        print("✅ Half-written index entry dropped")
+
+        # Index entry pointing at a record that was cut off
+        with open(store.log_path, "ab") as log, open(store.index_path, "ab") as index:
+            log.write(struct.pack(">I", 100) + b'{"role":')
+            index.write(struct.pack(">Q", log_size))
+        store = ConversationStore("torn", directory=directory, snapshot_interval=100)
+        assert store.count == 5 and store.messages[1:] == turns, store.messages
+        assert os.path.getsize(store.log_path) == log_size
+        assert os.path.getsize(store.index_path) == index_size
+        store.close()
+        print("✅ Truncated record dropped")
+
+        # Complete record whose index entry was never written
+        with open(store.log_path, "ab") as log:
+            data = b'{"role":"user","content":"lost"}'
+            log.write(struct.pack(">I", len(data)) + data)
+        store = ConversationStore("torn", directory=directory, snapshot_interval=100)
+        assert store.count == 5 and os.path.getsize(store.log_path) == log_size
+        # Appending after recovery continues at the right offsets
+        extra = {"role": "user", "content": "after recovery"}
+        store.append(extra)
+        assert store.read_messages(0) == turns + [extra]
+        store.close()
+        store = ConversationStore("torn", directory=directory, snapshot_interval=100)
+        assert store.count == 6 and store.messages[1:] == turns + [extra], store.messages
+        store.close()
+        print("✅ Unindexed record dropped and appends resume")
+
+    return True
+
+def test_conversation_store_snapshot_resume():
+    """Test that resuming from a snapshot plus the log tail equals a full replay"""
+    print("Testing conversation store snapshot resume...")
+    import tempfile
+    from src.client.mcp_client import ConversationStore
+
+    options = {"max_in_memory": 6, "snapshot_interval": 4}
+    for count in (3, 8, 11, 14):
+        turns = _conversation_turns(count)
+        with tempfile.TemporaryDirectory() as directory:
+            store = ConversationStore("snap", directory=directory, **options)
+            for message in turns:
+                store.append(message)
+            live_messages, live_window_start = list(store.messages), store.window_start
+            store.close()
+            assert live_messages[1:] == turns[live_window_start:], (count, live_messages)
+
+            resumed = ConversationStore("snap", directory=directory, **options)
+            resumed.close()
+            assert os.path.exists(resumed.snapshot_path) == (count >= options["snapshot_interval"])
+
+            if os.path.exists(resumed.snapshot_path):
+                os.remove(resumed.snapshot_path)
+            replayed = ConversationStore("snap", directory=directory, **options)
+            replayed.close()
+
+            for store in (resumed, replayed):
+                assert store.count == count
+                assert store.window_start == live_window_start, (count, store.window_start, live_window_start)
+                assert store.messages == live_messages, (count, store.messages)
+                assert store.read_messages(0) == turns
+                assert store.read_messages(store.window_start) == store.messages[1:]
+    print("✅ Snapshot plus tail matches the live window and a full replay")
+
+    return True
+
+def test_batch_atomic_rollback():
+    """Test that a failed atomic batch removes what it created, children first"""
+    print("Testing atomic batch rollback...")
+    import tempfile
+    from unittest import mock
+    from src.server import mcp_server
+
+    with tempfile.TemporaryDirectory() as root:
+        def path(*parts):
+            return os.path.join(root, *parts)
+
+        operations = [
+            {"op": "create_directory", "path": path("a")},
+            {"op": "create_text_file", "path": path("top.txt"), "content": "top"},
+            {"op": "create_directory", "path": path("a", "b")},
+            {"op": "create_text_file", "path": path("a", "b", "f.txt"), "content": "f"},
+            {"op": "create_directory", "path": path("a", "b", "c")},
+            {"op": "create_text_file", "path": path("a", "b", "c", "boom.txt"), "content": "boom"},
+        ]
+        levels, parents, errors = mcp_server._validate_batch(operations)
+        assert not errors, errors
+        assert levels == {0: 0, 1: 0, 2: 1, 3: 2, 4: 2, 5: 3}, levels
+        assert parents == {2: 0, 3: 2, 4: 2, 5: 4}, parents
+
+        # Fail the deepest operation once everything above it exists
+        create_text_file = mcp_server.create_text_file
+        def failing_create_text_file(file_path, content, mode="create"):
+            if file_path.endswith("boom.txt"):
+                return {"error": "Disk full"}
+            return create_text_file(file_path, content, mode)
+
+        with mock.patch.object(mcp_server, "create_text_file", failing_create_text_file):
+            result = mcp_server.batch_operations(operations, atomic=True)
+        assert result["success"] is False and result["rolled_back"] is True, result
+        assert [r.get("rolled_back", False) for r in result["results"]] == [True] * 5 + [False], result
+        assert result["results"][5]["error"] == "Disk full", result
+        assert os.listdir(root) == [], os.listdir(root)
+        print("✅ Failed atomic batch rolled back completely")
+
+        # Rollback removes children before parents whatever order they completed in
+        for op in operations[:5]:
+            if op["op"] == "create_directory":
+                os.mkdir(op["path"])
+            else:
+                with open(op["path"], "w") as f:
+                    f.write(op["content"])
+        removed = []
+        rmdir, unlink = mcp_server.Path.rmdir, mcp_server.Path.unlink
+        def recording_rmdir(self):
+            removed.append(str(self))
+            return rmdir(self)
+        def recording_unlink(self, missing_ok=False):
+            removed.append(str(self))
+            return unlink(self, missing_ok)
+        with mock.patch.object(mcp_server.Path, "rmdir", recording_rmdir), \
+                mock.patch.object(mcp_server.Path, "unlink", recording_unlink):
+            mcp_server._rollback_batch(operations, [0, 1, 2, 3, 4])
+        assert os.listdir(root) == [], os.listdir(root)
+        for i, parent_op in parents.items():
+            if i < 5:
+                child, parent = operations[i]["path"], operations[parent_op]["path"]
+                assert removed.index(child) < removed.index(parent), removed
+        print("✅ Rollback removed children before their parents")
+
+        # Invalid batch: nothing runs at all
+        operations[5] = {"op": "create_text_file", "path": path("missing", "x.txt")}
+        result = mcp_server.batch_operations(operations, atomic=True)
+        assert result["success"] is False and "rolled_back" not in result, result
+        assert result["results"][5]["error"].startswith("Parent directory does not exist"), result
+        assert all(r["error"] == "Not executed, batch rejected by validation" for r in result["results"][:5]), result
+        assert os.listdir(root) == [], os.listdir(root)
+        print("✅ Atomic batch rejected by validation created nothing")
+
+    return True
+
+def test_deterministic_profiling_of_search():
+    """Test that deterministic profiling covers search_items, including its worker thread"""
+    print("Testing deterministic profiling of search_items...")
+    import asyncio
+    import pstats
+    import tempfile
+    from src.server import mcp_server
+
+    def profiled_functions(path):
+        return {name for _, _, name in pstats.Stats(path).stats}
+
+    async def search(root):
+        result = await mcp_server.mcp.call_tool("search_items", {"path": root, "search_query": "needle"})
+        # Newer FastMCP versions return (content, structured result)
+        content = result[0] if isinstance(result, tuple) else result
+        found = json.loads(content[0].text)
+        assert found["found_files"] == [os.path.join(root, "sub", "needle.txt")], found
+
+    async def run(root, profile_dir):
+        profiler = mcp_server.tool_profiler
+        profiler.output_dir = profile_dir
+
+        # Per-tool session, with two calls in flight at once
+        status = profiler.start("deterministic", tool="search_items", calls=2)
+        assert status.get("active"), status
+        await asyncio.gather(search(root), search(root))
+        assert profiler.active is None and profiler.last_output["calls"] == 2, profiler.last_output
+        functions = profiled_functions(profiler.last_output["path"])
+        assert "search_items" in functions and "find_items" in functions, sorted(functions)
+        print("✅ Per-tool session profiled search_items and its worker thread")
+
+        # Window session
+        status = profiler.start("deterministic", seconds=60)
+        assert status.get("active"), status
+        await search(root)
+        output = profiler.stop()
+        functions = profiled_functions(output["path"])
+        assert "find_items" in functions, sorted(functions)
+        print("✅ Window session profiled the worker thread of search_items")
+
+        # Nothing is left enabled: another session can start and search still works
+        assert profiler.start("deterministic", seconds=60).get("active")
+        await search(root)
+        profiler.stop()
+
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as profile_dir:
+        os.makedirs(os.path.join(root, "sub"))
+        with open(os.path.join(root, "sub", "needle.txt"), "w") as f:
+            f.write("x")
+        asyncio.run(run(root, Path(profile_dir)))
+
+    return True
+
+def test_search_limits_and_ranking():
+    """Test max_results, max_depth, time_budget and rank_by of search_items"""
+    print("Testing search limits and ranking...")
+    import tempfile
+    from src.server.mcp_server import TopKMatches, find_items
+    from src.client.mcp_client import decode_compact_result, prepare_tool_arguments
+
+    with tempfile.TemporaryDirectory() as root:
+        def path(*parts):
+            return os.path.join(root, *parts)
+
+        os.makedirs(path("d1", "d2"))
+        names = [("x_new.txt",), ("d1", "x_mid.txt"), ("d1", "d2", "x_old.txt")]
+        for age, parts in zip((0, 100, 200), reversed(names)):
+            with open(path(*parts), "w") as f:
+                f.write("x")
+            os.utime(path(*parts), (1_000_000 + age, 1_000_000 + age))
+
+        for use_index in (False, True):
+            exact = find_items(root, "x_", max_results=3, use_index=use_index)
+            assert len(exact["found_files"]) == 3 and exact["truncated"] is False, exact
+            limited = find_items(root, "x_", max_results=2, use_index=use_index)
+            assert len(limited["found_files"]) == 2, limited
+            assert limited["truncated"] is True and limited["truncated_reason"] == "max_results", limited
+
+            shallow = find_items(root, "x_", max_depth=0, use_index=use_index)
+            assert shallow["found_files"] == [path("x_new.txt")], shallow
+            assert shallow["truncated"] is False, shallow
+            middle = find_items(root, "x_", max_depth=1, use_index=use_index)
+            assert sorted(middle["found_files"]) == [path("d1", "x_mid.txt"), path("x_new.txt")], middle
+        print("✅ max_results and max_depth, with and without the index")
+
+        out_of_time = find_items(root, "x_", time_budget=0)
+        assert out_of_time["truncated"] is True and out_of_time["truncated_reason"] == "deadline", out_of_time
+        print("✅ time_budget stops the search")
+
+        recency = find_items(root, "x_", rank_by="recency")
+        assert recency["found_files"] == [path(*parts) for parts in names], recency
+        depth = find_items(root, "x_", rank_by="depth", max_results=2)
+        assert depth["found_files"] == [path("x_new.txt"), path("d1", "x_mid.txt")], depth
+        assert depth["rank_by"] == "depth", depth
+        # The client keeps ranked searches in the flat format, the tree would lose their order
+        arguments = prepare_tool_arguments("search_items", {"path": root, "search_query": "x_", "rank_by": "recency"})
+        assert "result_format" not in arguments, arguments
+        assert prepare_tool_arguments("search_items", {"path": root, "search_query": "x_"})["result_format"] == "tree"
+        tree = find_items(root, "x_", result_format="tree", max_results=2)
+        assert decode_compact_result(tree)["found_files"] == limited["found_files"], tree
+        print("✅ rank_by orders results, the client does not compact ranked searches")
+
+    top = TopKMatches(2, "quality")
+    for score, name in ((0.5, "a"), (0.9, "b"), (0.7, "c"), (0.9, "d"), (0.1, "e")):
+        top.add(score, name, False, 0)
+    # Equal scores keep walk order
+    assert top.results() == ([(0.9, "b"), (0.9, "d")], []), top.results()
+    top = TopKMatches(3, "depth")
+    for depth, (name, is_dir) in enumerate((("deep", False), ("mid", True), ("top", False))):
+        top.add(0.5, name, is_dir, 2 - depth)
+    assert top.results() == ([(0.5, "top"), (0.5, "deep")], [(0.5, "mid")]), top.results()
+    print("✅ TopKMatches keeps the best k")
+
+    return True
+
+def test_read_text_file_ranges():
+    """Test byte and line ranges of read_text_file and append mode of create_text_file"""
+    print("Testing ranged reads and appends...")
+    import tempfile
+    from src.server.mcp_server import create_text_file, read_text_file
+
+    text = "first line\nzweite Zeile mit é und ü\n" + "long " * 20 + "€nd\n\nlast line without newline"
+    with tempfile.TemporaryDirectory() as root:
+        file_path = os.path.join(root, "text.txt")
+        assert create_text_file(file_path, text).get("success")
+        size = len(text.encode("utf-8"))
+
+        whole = read_text_file(file_path)
+        assert whole["content"] == text and whole["eof"] is True and whole["next_offset"] == size, whole
+
+        # Following next_offset reads the file exactly once, even with chunks shorter than a character
+        for length in (1, 2, 3, 7):
+            parts, offset = [], 0
+            for _ in range(size + 1):
+                chunk = read_text_file(file_path, offset=offset, length=length)
+                assert chunk["next_offset"] > offset, (length, chunk)
+                parts.append(chunk["content"])
+                offset = chunk["next_offset"]
+                if chunk["eof"]:
+                    break
+            assert "".join(parts) == text, (length, parts)
+        e_offset = text.encode("utf-8").index("é".encode("utf-8"))
+        assert read_text_file(file_path, offset=e_offset, length=1)["content"] == "é"
+        # An offset inside a character starts at that character
+        assert read_text_file(file_path, offset=e_offset + 1, length=2)["content"] == "é"
+        print("✅ Byte ranges advance by whole characters")
+
+        lines = read_text_file(file_path, start_line=2, end_line=3)
+        assert lines["content"] == "".join(text.splitlines(True)[1:3]), lines
+        # eof: the requested range is complete
+        assert lines["next_line"] == 4 and lines["eof"] is True, lines
+        rest = read_text_file(file_path, start_line=4, offset=lines["next_offset"])
+        assert rest["content"] == "".join(text.splitlines(True)[3:]) and rest["eof"] is True, rest
+        assert read_text_file(file_path, start_line=4)["content"] == rest["content"]
+        assert "error" in read_text_file(file_path, start_line=2, offset=e_offset + 1)
+
+        # Lines longer than length come in parts that continue the same line
+        for length in (1, 4, 16):
+            parts, line, offset, partial_seen = [], 1, 0, False
+            for _ in range(size + 1):
+                chunk = read_text_file(file_path, start_line=line, offset=offset, length=length)
+                assert "error" not in chunk, chunk
+                assert chunk["next_offset"] > offset, (length, chunk)
+                partial_seen = partial_seen or chunk.get("partial_line", False)
+                parts.append(chunk["content"])
+                line, offset = chunk["next_line"], chunk["next_offset"]
+                if chunk["eof"]:
+                    break
+            assert "".join(parts) == text and partial_seen, (length, parts)
+        print("✅ Line ranges, including lines longer than one chunk")
+
+        assert create_text_file(file_path, "again").get("error", "").startswith("File already exists")
+        appended = create_text_file(file_path, "\nappended ✓", mode="append")
+        assert appended.get("success") and appended["size"] == size + len("\nappended ✓".encode("utf-8")), appended
+        assert read_text_file(file_path)["content"] == text + "\nappended ✓"
+        missing = create_text_file(os.path.join(root, "missing.txt"), "x", mode="append")
+        assert missing.get("error", "").startswith("File not found for append"), missing
+        assert "error" in create_text_file(os.path.join(root, "other.txt"), "x", mode="overwrite")
+        print("✅ Append mode extends existing files only")
+
+    return True
+
+def test_prefill_stats():
+    """Test that prefill savings only count requests that reused the cached prefix"""
+    print("Testing prefill stats...")
+    from src.client.mcp_client import PrefillStats
+
+    stats = PrefillStats()
+    stats.record_prefix({"prompt_eval_count": 400, "prompt_eval_duration": 800_000_000})
+    for evaluated in (450, 420):
+        # The prompt was evaluated from scratch, e.g. because the tools sent changed
+        stats.record_turn({"prompt_eval_count": evaluated, "prompt_eval_duration": evaluated * 2_000_000})
+    assert "reused by 0 of 2 requests (~0 ms" in stats.summary(), stats.summary()
+    stats.record_turn({"prompt_eval_count": 30, "prompt_eval_duration": 60_000_000})
+    assert "reused by 1 of 3 requests (~800 ms" in stats.summary(), stats.summary()
+    print("✅ Only cache hits count as prefill saved")
+
+    return True
+
+def test_compression_middleware():
+    """Test content coding negotiation and compression of complete and streamed responses"""
+    print("Testing compression middleware...")
+    import asyncio
+    import gzip
+    import zlib
+    from src.server.mcp_server import CompressionMiddleware, _choose_encoding
+
+    assert _choose_encoding("gzip, deflate, br", ("zstd", "gzip")) == "gzip"
+    assert _choose_encoding("gzip;q=0.5, zstd", ("zstd", "gzip")) == "zstd"
+    assert _choose_encoding("zstd;q=0.2, gzip;q=0.8", ("zstd", "gzip")) == "gzip"
+    assert _choose_encoding("*", ("zstd", "gzip")) == "zstd"
+    assert _choose_encoding("*, zstd;q=0", ("zstd", "gzip")) == "gzip"
+    for refused in ("gzip;q=0", "identity;q=1, gzip;q=0", "identity, gzip;q=0.5", "", "br"):
+        assert _choose_encoding(refused, ("gzip",)) is None, refused
+    print("✅ Accept-Encoding q-values are honoured")
+
+    def app_sending(start_headers, chunks):
+        async def app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": start_headers})
+            for position, chunk in enumerate(chunks):
+                await send({"type": "http.response.body", "body": chunk, "more_body": position < len(chunks) - 1})
+        return app
+
+    def call(app, accept_encoding):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+        asyncio.run(CompressionMiddleware(app, encodings=("gzip",), minimum_size=1024)(scope, None, send))
+        headers = {name.decode().lower(): value.decode() for name, value in messages[0]["headers"]}
+        return headers, messages[1:]
+
+    small = b'{"result": "ok"}'
+    headers, bodies = call(app_sending([(b"content-length", str(len(small)).encode())], [small]), "gzip")
+    assert "content-encoding" not in headers and bodies[0]["body"] == small, (headers, bodies)
+
+    large = json.dumps({"files": [f"/data/file_{i}.txt" for i in range(2000)]}).encode()
+    headers, bodies = call(app_sending([(b"content-length", str(len(large)).encode())], [large]), "gzip")
+    assert headers["content-encoding"] == "gzip" and "accept-encoding" in headers["vary"].lower(), headers
+    assert int(headers["content-length"]) == len(bodies[0]["body"]) < len(large), headers
+    assert gzip.decompress(bodies[0]["body"]) == large
+    headers, bodies = call(app_sending([(b"content-length", str(len(large)).encode())], [large]), "identity;q=1, gzip;q=0")
+    assert "content-encoding" not in headers and bodies[0]["body"] == large, headers
+    print("✅ Small responses pass unchanged, large ones are compressed with a correct Content-Length")
+
+    events = [f"event: message\ndata: {json.dumps({'id': i, 'text': 'x' * (i * 700)})}\n\n".encode() for i in range(5)]
+    headers, bodies = call(app_sending([(b"content-type", b"text/event-stream")], events), "gzip")
+    assert headers["content-encoding"] == "gzip" and "content-length" not in headers, headers
+    decoder = zlib.decompressobj(31)
+    for event, message in zip(events, bodies):
+        # Every event can be decoded as soon as its chunk arrives
+        assert decoder.decompress(message["body"]) == event
+    assert bodies[-1]["more_body"] is False and decoder.eof
+    print("✅ Streamed SSE events decode chunk by chunk")
+
+    return True
+
+def test_listing_cache_invalidation():
+    """Test that cached listings are dropped by inotify events, or by mtime checks without a watch"""
+    print("Testing directory listing cache invalidation...")
+    import tempfile
+    from starlette.applications import Starlette
+    from starlette.routing import Route
+    from starlette.testclient import TestClient
+    from src.server import mcp_server
+    from src.server.mcp_server import DirectoryListingCache
+
+    def lister(directory):
+        def load():
+            return {"names": sorted(os.listdir(directory))}
+        return load
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DirectoryListingCache()
+        assert cache.get_or_load(directory, lister(directory)) == {"names": []}
+        assert cache.get_or_load(directory, lister(directory)) == {"names": []}
+        if cache.stats()["inotify"]:
+            assert cache.stats()["watches"] == 1
+            with open(os.path.join(directory, "new.txt"), "w") as f:
+                f.write("x")
+            deadline = time.monotonic() + 5
+            while cache.stats()["invalidations"] == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert cache.stats()["invalidations"] == 1, cache.stats()
+            assert cache.get_or_load(directory, lister(directory)) == {"names": ["new.txt"]}
+            # A changed file size is only seen through the watch, metadata listings rely on it
+            with open(os.path.join(directory, "new.txt"), "a") as f:
+                f.write("more")
+            deadline = time.monotonic() + 5
+            while cache.stats()["invalidations"] == 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert cache.stats()["invalidations"] == 2, cache.stats()
+            print("✅ inotify events invalidate cached listings")
+        else:
+            print("⚠️  inotify not available, only the mtime fallback is tested")
+            with open(os.path.join(directory, "new.txt"), "w") as f:
+                f.write("x")
+
+    with tempfile.TemporaryDirectory() as directory:
+        # No watches: entries are checked against the directory mtime
+        cache = DirectoryListingCache(max_watches=0)
+        assert cache.get_or_load(directory, lister(directory)) == {"names": []}
+        assert cache.get_or_load(directory, lister(directory)) == {"names": []}
+        assert cache.stats()["watches"] == 0 and cache.stats()["hits"] == 1, cache.stats()
+        with open(os.path.join(directory, "new.txt"), "w") as f:
+            f.write("x")
+        assert cache.get_or_load(directory, lister(directory)) == {"names": ["new.txt"]}
+        # Unwatched listings that need a watch (file metadata) are never served from the cache
+        assert cache.get_or_load(directory, lister(directory), needs_watch=True) == {"names": ["new.txt"]}
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["invalidations"]) == (1, 3, 2), stats
+        assert stats["hit_rate"] == 0.25, stats
+        print("✅ Without a watch, listings are validated against the directory mtime")
+
+    app = Starlette(routes=[Route("/admin/cache", mcp_server.cache_endpoint)])
+    response = TestClient(app).get("/admin/cache")
+    assert response.status_code == 200 and response.json() == mcp_server.listing_cache.stats(), response.text
+    print("✅ /admin/cache returns the cache stats")
+
+    return True
+
+def test_tool_result_cache():
+    """Test that cached read-only results are dropped when a write touches their path"""
+    print("Testing tool result cache...")
+    import asyncio
+    import tempfile
+    from mcp.shared.memory import create_connected_server_and_client_session
+    from src.server import mcp_server
+    from src.client.mcp_client import ToolResultCache
+
+    def listed_files(result):
+        return json.loads(result.content[0].text)["files"]
+
+    async def run(base):
+        cache = ToolResultCache()
+        root, other = os.path.join(base, "listed"), os.path.join(base, "other")
+        os.makedirs(root)
+        os.makedirs(other)
+        async with create_connected_server_and_client_session(mcp_server.mcp) as session:
+            async def list_items(path=root):
+                return await cache.call(session, "list_items", {"path": path})
+
+            first = await list_items()
+            assert await list_items() is first and (cache.hits, cache.misses) == (1, 1)
+            await list_items(other)
+
+            # A write in a sibling keeps the entry, one below the listed directory drops it
+            await cache.call(session, "create_text_file", {"file_path": os.path.join(other, "x.txt"), "content": "x"})
+            assert await list_items() is first and cache.hits == 2
+            assert listed_files(await list_items(other)) == ["x.txt"] and cache.misses == 3
+            await cache.call(session, "create_text_file", {"file_path": os.path.join(root, "a.txt"), "content": "a"})
+            assert listed_files(await list_items()) == ["a.txt"] and cache.misses == 4
+            # Writing to an ancestor's subtree also drops results for the ancestor, e.g. searches
+            await cache.call(session, "search_items", {"path": base, "search_query": "a.txt"})
+            await cache.call(session, "create_directory", {"directory_path": os.path.join(other, "deeper")})
+            await cache.call(session, "search_items", {"path": base, "search_query": "a.txt"})
+            assert cache.misses == 6, cache.misses
+
+            # batch_operations drops entries for every path it writes
+            read = await cache.call(session, "read_text_file", {"file_path": os.path.join(root, "a.txt")})
+            await cache.call(session, "batch_operations", {"operations": [
+                {"op": "create_directory", "path": os.path.join(root, "sub")},
+                {"op": "create_text_file", "path": os.path.join(root, "sub", "b.txt"), "content": "b"},
+            ]})
+            assert listed_files(await list_items()) == ["a.txt"] and cache.misses == 8
+            assert await cache.call(session, "read_text_file", {"file_path": os.path.join(root, "a.txt")}) is read
+
+            # Appending to a file drops its cached contents
+            await cache.call(session, "create_text_file", {"file_path": os.path.join(root, "a.txt"), "content": "!", "mode": "append"})
+            read = await cache.call(session, "read_text_file", {"file_path": os.path.join(root, "a.txt")})
+            assert json.loads(read.content[0].text)["content"] == "a!"
+
+            # Truncated and failed results are not kept
+            misses = cache.misses
+            for _ in range(2):
+                await cache.call(session, "search_items", {"path": root, "search_query": ".txt", "max_results": 1})
+                await cache.call(session, "list_items", {"path": os.path.join(root, "missing")})
+            assert cache.misses == misses + 4, cache.misses
+
+    with tempfile.TemporaryDirectory() as base:
+        asyncio.run(run(base))
+    print("✅ Writes drop overlapping cached results only; partial and error results are not cached")
+
+    return True
+
+def test_search_match_modes():
+    """Test glob, regex and fuzzy matching, with and without the trigram index"""
+    print("Testing search match modes...")
+    import tempfile
+    from src.server.mcp_server import NameMatcher, create_text_file, find_items
+
+    with tempfile.TemporaryDirectory() as root:
+        for name in ("report_2024.txt", "Report_final.md", "readme.md", "notes.txt",
+                     os.path.join("src", "main.py"), os.path.join("src", "utils.py"), os.path.join("docs", "reprot.txt")):
+            os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+            with open(os.path.join(root, name), "w") as f:
+                f.write("x")
+
+        expected = {
+            ("report", "substring"): {"report_2024.txt", "Report_final.md"},
+            ("*.py", "glob"): {"main.py", "utils.py"},
+            ("R*.MD", "glob"): {"readme.md", "Report_final.md"},
+            (r"^re.*\.md$", "regex"): {"readme.md", "Report_final.md"},
+            (r"\d{4}", "regex"): {"report_2024.txt"},
+            ("raport", "fuzzy"): {"report_2024.txt", "Report_final.md"},
+            ("py", "fuzzy"): {"main.py", "utils.py"},
+        }
+        for (query, mode), names in expected.items():
+            walked = find_items(root, query, match_mode=mode)
+            indexed = find_items(root, query, match_mode=mode, use_index=True)
+            assert {os.path.basename(p) for p in walked["found_files"]} == names, (query, mode, walked)
+            # The index finds the same matches with the same scores
+            assert sorted(zip(walked["found_files"], walked["file_scores"])) == \
+                sorted(zip(indexed["found_files"], indexed["file_scores"])), (query, mode, indexed)
+        print("✅ substring, glob, regex and fuzzy matches agree with and without the index")
+
+        # Better matches rank first
+        scores = find_items(root, "r", use_index=True)["file_scores"]
+        assert len(scores) > 2 and scores == sorted(scores, reverse=True), scores
+        assert NameMatcher("rep").score("report.txt") > NameMatcher("rep").score("my_report.txt")
+        assert NameMatcher("py", "fuzzy").mode == "substring"
+
+        assert "error" in find_items(root, "(", match_mode="regex")
+        assert "error" in find_items(root, "x", match_mode="soundex")
+
+        # Files created through the server are found by an existing index
+        assert find_items(root, "fresh", use_index=True)["found_files"] == []
+        assert create_text_file(os.path.join(root, "src", "fresh_module.py"), "x").get("success")
+        assert find_items(root, "fresh", use_index=True)["found_files"] == [os.path.join(root, "src", "fresh_module.py")]
+        print("✅ Ranking, invalid queries and index invalidation")
+
+    return True
+
+def test_call_deadline():
+    """Test that a call's deadline stops search_items and returns a partial result"""
+    print("Testing call deadlines...")
+    import asyncio
+    import tempfile
+    from mcp.shared.memory import create_connected_server_and_client_session
+    from src.server import mcp_server
+    from src.server.mcp_server import CancelToken
+    from src.client.mcp_client import call_tool_with_deadline
+
+    token = CancelToken(0.05)
+    assert not token.should_stop()
+    time.sleep(0.06)
+    assert token.should_stop() and token.reason == "deadline"
+    token = CancelToken()
+    token.cancel("max_results")
+    token.cancel()
+    assert token.should_stop() and token.reason == "max_results"
+    assert not CancelToken().should_stop()
+
+    async def run(root):
+        async with create_connected_server_and_client_session(mcp_server.mcp) as session:
+            arguments = {"path": root, "search_query": "file"}
+            result = json.loads((await call_tool_with_deadline(session, "search_items", arguments, timeout=0)).content[0].text)
+            assert result["truncated"] is True and result["truncated_reason"] == "deadline", result
+            # The call's deadline applies even when the model asked for a longer time_budget
+            result = json.loads((await call_tool_with_deadline(
+                session, "search_items", dict(arguments, time_budget=60), timeout=0)).content[0].text)
+            assert result["truncated_reason"] == "deadline", result
+            # With the default deadline the search completes
+            result = json.loads((await call_tool_with_deadline(session, "search_items", arguments)).content[0].text)
+            assert result["truncated"] is False and len(result["found_files"]) == 20, result
+
+    with tempfile.TemporaryDirectory() as root:
+        for i in range(20):
+            os.makedirs(os.path.join(root, f"dir{i}"))
+            with open(os.path.join(root, f"dir{i}", f"file{i}.txt"), "w") as f:
+                f.write("x")
+        asyncio.run(run(root))
+    print("✅ A passed deadline returns a partial result marked truncated_reason 'deadline'")
+
+    return True
+
+def test_server_pool_routing():
+    """Test MCP_SERVERS parsing and routing of namespaced tools across two servers"""
+    print("Testing server pool routing...")
+    import asyncio
+    import tempfile
+    from src.client import mcp_client
+    from src.client.mcp_client import ServerPool, parse_servers
+
+    assert parse_servers("http://10.0.0.1:8085/mcp") == {"10_0_0_1": "http://10.0.0.1:8085/mcp"}
+    assert parse_servers(" node1=http://a:1/mcp , node2 = http://b:2/mcp ,") == \
+        {"node1": "http://a:1/mcp", "node2": "http://b:2/mcp"}
+    assert parse_servers("http://host:1/mcp,http://host:2/mcp") == \
+        {"host": "http://host:1/mcp", "host_2": "http://host:2/mcp"}
+    assert parse_servers("my node=http://a:1/mcp,=http://b:2/mcp") == \
+        {"my_node": "http://a:1/mcp", "server2": "http://b:2/mcp"}
+    assert parse_servers("") == {}
+    print("✅ MCP_SERVERS parsing")
+
+    async def run(urls):
+        async with ServerPool(urls, transport="sse", connect_timeout=15) as pool:
+            names = {tool.name for tool in pool.tools}
+            assert {"alpha__fetch_weather", "beta__fetch_weather", "alpha__list_items"} <= names, names
+            for server in urls:
+                result = await pool.call_tool(f"{server}__fetch_weather", {"latitude": 1.0, "longitude": 2.0})
+                assert result.content[0].text == f"weather from {server}", result
+            assert pool.route("beta__list_items") == (pool.sessions["beta"], "list_items")
+            try:
+                pool.route("fetch_weather")
+                raise AssertionError("an unprefixed tool name was routed")
+            except ValueError:
+                pass
+        async with ServerPool({"alpha": urls["alpha"]}, transport="sse") as pool:
+            # A single server keeps the plain tool names
+            assert "fetch_weather" in {tool.name for tool in pool.tools}
+            result = await pool.call_tool("fetch_weather", {"latitude": 1.0, "longitude": 2.0})
+            assert result.content[0].text == "weather from alpha", result
+
+    processes = []
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            urls = {}
+            for server in ("alpha", "beta"):
+                stub_path = os.path.join(directory, f"{server}.json")
+                with open(stub_path, "w") as f:
+                    json.dump({"1.0,2.0": f"weather from {server}"}, f)
+                port = mcp_client._free_port("127.0.0.1")
+                processes.append(subprocess.Popen([
+                    sys.executable, "-m", "src.server.mcp_server", "--host", "127.0.0.1", "--port", str(port),
+                    "--weather-stub", stub_path, "--log-level", "WARNING",
+                ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                assert asyncio.run(mcp_client.wait_for_port("127.0.0.1", port, process=processes[-1])), server
+                urls[server] = f"http://127.0.0.1:{port}/mcp"
+            asyncio.run(run(urls))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(timeout=10)
+    print("✅ Namespaced tools are routed to the server that owns them")
+
+    return True
+
 def main():
     print("=" * 50)
     print("MCP Client X - Test Suite")
@@ -116,6 +864,20 @@ def main():
         ("Import Test", test_imports),
         ("Server Start Test", test_server_start),
         ("PyInstaller Test", test_pyinstaller),
+        ("Path Tree Round Trip Test", test_path_tree_round_trip),
+        ("Conversation Store Torn Tail Test", test_conversation_store_torn_tail),
+        ("Conversation Store Snapshot Resume Test", test_conversation_store_snapshot_resume),
+        ("Batch Atomic Rollback Test", test_batch_atomic_rollback),
+        ("Deterministic Profiling Test", test_deterministic_profiling_of_search),
+        ("Search Limits And Ranking Test", test_search_limits_and_ranking),
+        ("Ranged Read Test", test_read_text_file_ranges),
+        ("Prefill Stats Test", test_prefill_stats),
+        ("Compression Middleware Test", test_compression_middleware),
+        ("Listing Cache Invalidation Test", test_listing_cache_invalidation),
+        ("Tool Result Cache Test", test_tool_result_cache),
+        ("Search Match Modes Test", test_search_match_modes),
+        ("Call Deadline Test", test_call_deadline),
+        ("Server Pool Routing Test", test_server_pool_routing),
     ]
     
     results = []